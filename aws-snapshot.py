@@ -1,19 +1,26 @@
-import boto3
-import botocore
 from datetime import datetime
 from pytz import UTC
 from os import getenv, path
-from json import load
+from json import load, dump
 from socket import gethostname
-import requests
+import threading
 import logging
 import getopt
+import time
 import sys
-from libs import slacksend, emailsend
+from libs import changeestimate, copypipeline, instanceidentity, inventory, inventorycache, metrics, notifyspool, retention, runlock, snapshotindex, snapshotoutput, snapshotwaiter, statefile, throttle, volumeselector
 
 
-def init_configuration():
-    configuration = {
+def import_aws_modules():
+    # boto3 import takes most of startup time, so it is imported only when action works with AWS API
+    global boto3, botocore
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+
+
+def default_configuration():
+    return {
         "aws_region": "",
         "aws_key_id": "",
         "aws_key_secret": "",
@@ -24,6 +31,50 @@ def init_configuration():
         "snapshot_expire_search": "instance-id-tag",
         "snapshot_expire_days": 15,
         "snapshot_save_count": 1,
+        "snapshot_retention": {
+            "hourly": 0,
+            "daily": 0,
+            "weekly": 0,
+            "monthly": 0
+        },
+        "snapshot_archive": {
+            "archive_after_days": 0,
+            "archive_expire_days": 0,
+            "concurrency": 4
+        },
+        "inventory_file": "",
+        "state_location": "",
+        "inventory_cache": True,
+        "inventory_cache_ttl": 3600,
+        "inventory_cache_location": "",
+        "run_lock": "file",
+        "run_lock_location": "",
+        "run_lock_ttl": 7200,
+        "metadata_timeout": 1,
+        "metadata_cache_location": "",
+        "snapshot_mode": "volume",
+        "snapshot_change_estimate": False,
+        "snapshot_skip_if_unchanged": False,
+        "snapshot_concurrency": 4,
+        "snapshot_api_rate": 10,
+        "snapshot_api_retries": 5,
+        "snapshot_wait": False,
+        "snapshot_wait_interval": 5,
+        "snapshot_wait_timeout": 3600,
+        "fleet_enabled": False,
+        "fleet_filter": "tag:Backup=true",
+        "fleet_concurrency": 8,
+        "fleet_report_location": "/tmp/aws-snapshot-fleet.json",
+        "regions": [],
+        "regions_concurrency": 10,
+        "aws_profiles": [],
+        "snapshot_copy": {
+            "targets": [],
+            "max_concurrent_copies": 5,
+            "queue_size": 100,
+            "wait_interval": 30,
+            "wait_timeout": 7200
+        },
         "slack_notify_on": [],
         "email_notify_on": [],
         "smtp_connection": {
@@ -77,14 +128,29 @@ def init_configuration():
             }
         },
         "slack_users": [],
+        "notify_digest": {
+            "enabled": False,
+            "window": 86400,
+            "spool_location": "",
+            "retry_interval": 300,
+            "max_attempts": 10
+        },
         "log_location": "/tmp/aws-snapshot.log",
         "log_level": "INFO",
+        "metrics_location": "",
+        "metrics_format": "prometheus",
+        "output_format": "",
+        "output_location": "-",
         "debug": False
     }
 
+
+def init_configuration():
+    configuration = default_configuration()
+
     # Try load configuration from local config file
     if path.exists(default_config_file):
-        configuration.update(load_configuration_file(default_config_file))
+        configuration = configuration_merge(configuration, load_configuration_file(default_config_file))
     else:
         print ('Configuration file not found. Using default configuration')
 
@@ -93,8 +159,16 @@ def init_configuration():
     try:
         cmd_options, cmd_arguments = getopt.getopt(sys.argv[1:], "hd", ["help",
                                                                         "debug",
+                                                                        "no_cache",
+                                                                        "wait",
                                                                         "config=",
                                                                         "action=",
+                                                                        "fleet_filter=",
+                                                                        "regions=",
+                                                                        "profiles=",
+                                                                        "inventory_file=",
+                                                                        "output=",
+                                                                        "output_location=",
                                                                         "aws_key_id=",
                                                                         "aws_secret_key=",
                                                                         "aws_region="])
@@ -105,7 +179,8 @@ def init_configuration():
         if cmd_opt in ("-h", "--help"):
             show_help()
         elif cmd_opt == "--config":
-            configuration = load_configuration_file(configuration_file_path=cmd_arg, exit_on_error=True)
+            configuration = configuration_merge(default_configuration(),
+                                                load_configuration_file(configuration_file_path=cmd_arg, exit_on_error=True))
         elif cmd_opt == "--aws_key_id":
             configuration["aws_key_id"] = cmd_arg
         elif cmd_opt == "--aws_secret_key":
@@ -114,24 +189,85 @@ def init_configuration():
             configuration["aws_region"] = cmd_arg
         elif cmd_opt in ("-d", "--debug"):
             configuration["debug"] = True
+        elif cmd_opt == "--fleet_filter":
+            configuration["fleet_enabled"] = True
+            configuration["fleet_filter"] = cmd_arg
+        elif cmd_opt == "--regions":
+            configuration["regions"] = "all" if cmd_arg == "all" else cmd_arg.split(",")
+        elif cmd_opt == "--profiles":
+            configuration["aws_profiles"] = cmd_arg.split(",")
+        elif cmd_opt == "--wait":
+            configuration["snapshot_wait"] = True
+        elif cmd_opt == "--no_cache":
+            configuration["inventory_cache"] = False
+        elif cmd_opt == "--output":
+            configuration["output_format"] = cmd_arg
+        elif cmd_opt == "--output_location":
+            configuration["output_location"] = cmd_arg
+        elif cmd_opt == "--inventory_file":
+            configuration["inventory_file"] = cmd_arg
+            configuration["snapshot_action"] = "plan"
         elif cmd_opt in ("--action"):
 
             configuration["snapshot_action"] = cmd_arg
 
-    # Enable debug for status action
-    if configuration["snapshot_action"] == "status":
-        configuration["debug"] = True
+    # Fleet action runs default action for every matched instance
+    if configuration["snapshot_action"] == "fleet":
+        configuration["fleet_enabled"] = True
+        configuration["snapshot_action"] = "default"
+
+    # Instances in other regions and accounts can be found only by fleet filter
+    if configuration["regions"] or configuration["aws_profiles"]:
+        configuration["fleet_enabled"] = True
+
+    if configuration["output_format"] and configuration["output_format"] not in snapshotoutput.OUTPUT_FORMATS:
+        print ("unknown output format - {0}, use one of: {1}".format(configuration["output_format"], ", ".join(snapshotoutput.OUTPUT_FORMATS)))
+        sys.exit(1)
+
+    try:
+        volumeselector.VolumeSelector(configuration["snapshot_volumes"])
+    except ValueError as e:
+        print ("wrong snapshot_volumes - {0}".format(e))
+        sys.exit(1)
+
+    if configuration["fleet_enabled"]:
+        try:
+            ec2_get_fleet_filters(configuration["fleet_filter"])
+        except ValueError as e:
+            print ("{0}, use name=value1,value2 items, for example tag:Backup=true,tag:Env=prod,staging".format(e))
+            sys.exit(1)
+
+    # Enable debug for status and plan actions, unless records are streamed to stdout
+    if configuration["snapshot_action"] in ("status", "plan"):
+        configuration["debug"] = not (configuration["output_format"] and configuration["output_location"] == "-")
 
     # Load configuration from environment
     configuration["aws_region"] = getenv("AWS_DEFAULT_REGION", configuration["aws_region"])
     configuration["aws_key_id"] = getenv("AWS_ACCESS_KEY_ID", configuration["aws_key_id"])
     configuration["aws_key_secret"] = getenv("AWS_SECRET_ACCESS_KEY", configuration["aws_key_secret"])
 
+    try:
+        configuration_state_locations(configuration)
+    except OSError as e:
+        print ("can`t use state directory - {0}: {1}".format(configuration["state_location"], e))
+        sys.exit(1)
+
     # Configure logging
     logging.basicConfig(filename=configuration['log_location'], filemode='w', level=logging.INFO)
     return configuration
 
 
+def configuration_state_locations(configuration):
+    # Keep caches in state directory of user running script by default, never in world-writable /tmp
+    if not configuration["state_location"]:
+        configuration["state_location"] = path.expanduser(statefile.STATE_LOCATION)
+    statefile.make_state_directory(configuration["state_location"])
+    if not configuration["inventory_cache_location"]:
+        configuration["inventory_cache_location"] = path.join(configuration["state_location"], "aws-snapshot-cache.jsonl")
+    if not configuration["metadata_cache_location"]:
+        configuration["metadata_cache_location"] = path.join(configuration["state_location"], "aws-snapshot-identity.json")
+
+
 def show_help():
     print ("Usage:\n"
            "-h, --help - for help\n"
@@ -140,7 +276,15 @@ def show_help():
            "--aws_key_id='' - set AWS_ACCESS_KEY_ID\n"
            "--aws_secret_key='' - set AWS_SECRET_ACCESS_KEY\n"
            "--aws_region='' - set AWS_DEFAULT_REGION\n"
-           "--action='' - set script action - 'default\delete\\create\status'\n"
+           "--action='' - set script action - 'default\delete\\create\status\\plan\\fleet\\notify'\n"
+           "--fleet_filter='' - backup all instances matched by filter. Default: tag:Backup=true\n"
+           "--regions='' - comma separated list of regions or 'all' for fleet backup\n"
+           "--profiles='' - comma separated list of AWS profiles for fleet backup\n"
+           "--wait - wait until created snapshots are completed\n"
+           "--no_cache - do not use local snapshots inventory cache\n"
+           "--output='' - stream status or plan snapshot records as json, csv or ndjson\n"
+           "--output_location='' - file for --output records. Default: stdout\n"
+           "--inventory_file='' - print retention plan for exported describe-snapshots json without AWS calls\n"
            "--snapshot_name='' - set custom snapshot prefix name. Default: %instance_name%-%volume_id%-%date_short%\n"
            "--snapshot_expire_days= - set amount of days after that snapshots will be expired\n"
            "--snapshot_save_count= - minimum number of snapshots for save")
@@ -163,6 +307,18 @@ def load_configuration_file(configuration_file_path, exit_on_error=False):
             sys.exit(1)
 
 
+def configuration_merge(configuration, file_configuration):
+    # Options missing in file keep default values, also inside blocks like snapshot_archive
+    for option_name, option_value in (file_configuration or {}).items():
+        if isinstance(option_value, dict) and isinstance(configuration.get(option_name), dict):
+            option_block = dict(configuration[option_name])
+            option_block.update(option_value)
+            configuration[option_name] = option_block
+        else:
+            configuration[option_name] = option_value
+    return configuration
+
+
 def remove_special_charters(input_string):
     special_characters = "*$?^+,.[]|\/"
     input_string = input_string.translate(None, ''.join(special_characters))
@@ -170,12 +326,20 @@ def remove_special_charters(input_string):
     return input_string
 
 
-def log_error(error_message=""):
+def log_error(error_message="", instance_report=None):
     exceptions_pool.append(error_message)
+    if instance_report is not None:
+        instance_report["errors"].append(error_message)
     logging.error(error_message)
     return
 
 
+def log_warning(warning_message=""):
+    # Warnings are printed without debug too, so skipped work is visible in cron output
+    logging.warning(warning_message)
+    sys.stderr.write("{0}\n".format(warning_message))
+
+
 def print_debug_message(debug_message=""):
     logging.info(debug_message)
     if configuration["debug"]:
@@ -200,90 +364,140 @@ def snapshot_generate_name(instance_name="", volume_id=""):
 def ec2_get_instance_region():
     if not configuration["aws_region"]:
         try:
-            response = requests.get("http://169.254.169.254/latest/dynamic/instance-identity/document", timeout=5)
-            return response.json()["region"]
-        except requests.exceptions.ConnectTimeout:
-            log_error("Failed to get default instance AWS region")
+            return instance_identity.get()["region"]
+        except instanceidentity.METADATA_ERRORS as e:
+            log_error("Failed to get default instance AWS region: {0}".format(e))
     else:
         return configuration["aws_region"]
 
 
 def ec2_get_instance_id():
     try:
-        response = requests.get("http://169.254.169.254/latest/meta-data/instance-id", timeout=5)
-        return response.text
-    except requests.exceptions.ConnectTimeout:
-        log_error("Failed to get instance ID: can`t connect to AWS meta-data pool")
+        return instance_identity.get()["instanceId"]
+    except instanceidentity.METADATA_ERRORS as e:
+        log_error("Failed to get instance ID: can`t connect to AWS meta-data pool: {0}".format(e))
         return 'UnknownID'
 
 
-def ec2_get_instance_name(instance_id):
+def ec2_get_instance_name(instance_id, ec2_region):
     instance_name = gethostname()
 
     try:
-        instance = ec2.Instance(instance_id)
-        for instance_tag in instance.tags:
-            if instance_tag["Key"] == "Name" and instance_tag["Value"]:
-                instance_name = instance_tag["Value"]
+        response = ec2_region["client"].describe_instances(InstanceIds=[instance_id])
+        for reservation in response["Reservations"]:
+            for instance in reservation["Instances"]:
+                for instance_tag in instance.get("Tags", []):
+                    if instance_tag["Key"] == "Name" and instance_tag["Value"]:
+                        instance_name = instance_tag["Value"]
     except:
         log_error("Failed to get instance name: unknown API error. Using hostname")
 
     return instance_name
 
 
-def ec2_get_instance_volumes(instance_id):
-    volumes_list = []
-    instance = ec2.Instance(instance_id)
+def ec2_get_root_devices(instance_ids, ec2_region):
+    root_devices = {}
+    paginator = ec2_region["client"].get_paginator("describe_instances")
 
-    if "all" in configuration["snapshot_volumes"]:
-        try:
-            for volume in instance.volumes.all():
-                volumes_list.append(volume.id)
-        except:
-            log_error("Failed to get instance volumes: unknown API error")
-    else:
-        volumes_filtered = instance.volumes.filter(VolumeIds=configuration["snapshot_volumes"])
-        for volume in volumes_filtered:
-            volumes_list.append(volume.id)
+    for page in metrics.paginate(paginator, InstanceIds=instance_ids):
+        for reservation in page["Reservations"]:
+            for instance in reservation["Instances"]:
+                root_devices[instance["InstanceId"]] = instance.get("RootDeviceName")
 
-    return volumes_list
+    return root_devices
 
 
-def ec2_get_instance_snapshots(instance_id):
-    if "all" in configuration["snapshot_volumes"]:
-        instance_volumes_list = ec2_get_instance_volumes(instance_id)
-    else:
-        instance_volumes_list = configuration["snapshot_volumes"]
+def ec2_select_volumes(instance_ids, ec2_region, root_devices=None):
+    # Volumes of many instances are selected by one paginated DescribeVolumes call, result is kept for the run
+    selected_volumes = dict((instance_id, []) for instance_id in instance_ids)
+    if volume_selector.root is not None and root_devices is None:
+        root_devices = ec2_get_root_devices(instance_ids, ec2_region)
+    paginator = ec2_region["client"].get_paginator("describe_volumes")
+
+    for batch_start in range(0, len(instance_ids), volumeselector.FILTER_BATCH_SIZE):
+        batch_instance_ids = instance_ids[batch_start:batch_start + volumeselector.FILTER_BATCH_SIZE]
+        for page in metrics.paginate(paginator, Filters=volume_selector.filters(batch_instance_ids)):
+            for volume in page["Volumes"]:
+                for attachment in volume.get("Attachments", []):
+                    instance_id = attachment["InstanceId"]
+                    if instance_id in selected_volumes and volume_selector.match(volume, attachment, (root_devices or {}).get(instance_id)):
+                        selected_volumes[instance_id].append(volume["VolumeId"])
+
+    with volumes_selection_lock:
+        for instance_id, volumes_list in selected_volumes.items():
+            volumes_selection[(ec2_region["name"], instance_id)] = volumes_list
+
+    return selected_volumes
 
-    snapshots_dict = {'snapshots_list_total': [],
-                      'snapshots_list_expired': [],
-                      'snapshots_list_volumes': {},
-                      'snapshots_list_volumes_expired': {}}
 
-    snapshots_filtered = ec2.snapshots.filter(Filters=[{"Name": "tag:InstanceId", "Values": [instance_id]}])
+def ec2_get_instance_volumes(instance_id, ec2_region):
+    try:
+        return ec2_select_volumes([instance_id], ec2_region)[instance_id]
+    except botocore.exceptions.ClientError as e:
+        log_error("Failed to get instance volumes: {0}".format(e))
+        return []
+
+
+def ec2_get_snapshot_volumes(instance_id, ec2_region, instance_volumes_list=None):
+    if instance_volumes_list is None:
+        instance_volumes_list = volumes_selection.get((ec2_region["name"], instance_id))
+
+    # Volumes are not taken from inventory cache, so newly attached volume is snapshotted by the next run
+    if instance_volumes_list is None:
+        instance_volumes_list = ec2_get_instance_volumes(instance_id, ec2_region)
 
-    for volume in instance_volumes_list:
-        snapshots_volume_filtered = snapshots_filtered.filter(Filters=[{"Name": "volume-id", "Values": [volume]}])
-        snapshots_dict['snapshots_list_volumes'].update({volume: list(snapshots_volume_filtered)})
-        snapshots_dict['snapshots_list_volumes_expired'].update({volume: []})
-        snapshots_dict['snapshots_list_total'] += list(snapshots_volume_filtered)
+    return instance_volumes_list
 
-        for snapshot in snapshots_volume_filtered:
-            if (current_date - snapshot.start_time).days + 1 > configuration["snapshot_expire_days"]:
-                snapshots_dict['snapshots_list_volumes_expired'][volume].append(snapshot)
 
-        snapshots_dict['snapshots_list_expired'] += snapshots_dict['snapshots_list_volumes_expired'][volume]
+def ec2_get_instance_snapshots(instance_id, ec2_region, instance_volumes_list=None):
+    instance_volumes_list = ec2_get_snapshot_volumes(instance_id, ec2_region, instance_volumes_list)
+
+    snapshots_inventory = inventory.SnapshotInventory(ec2_client=ec2_region["client"])
+
+    if inventory_cache is not None:
+        snapshots_index = inventory_cache.get(instance_id,
+                                              volumes=instance_volumes_list,
+                                              current_date=current_date,
+                                              expire_days=configuration["snapshot_expire_days"])
+        if snapshots_index is not None:
+            # Only snapshots that still can change state are refreshed from API
+            pending_snapshots_ids = [snapshot.id for snapshot in snapshots_index if snapshot.state == "pending"]
+            try:
+                if pending_snapshots_ids:
+                    refreshed_snapshots_list = snapshots_inventory.describe_snapshot_ids(pending_snapshots_ids)
+                    for snapshot in refreshed_snapshots_list:
+                        snapshots_index.add(snapshot)
+                    inventory_cache.update(instance_id, refreshed_snapshots_list)
+                print_debug_message("Inventory loaded from cache, pending snapshots refreshed: {0}".format(len(pending_snapshots_ids)))
+                return snapshots_index
+            except botocore.exceptions.ClientError as e:
+                print_debug_message("Inventory cache refresh failed, loading full inventory: {0}".format(e))
+
+    snapshots_index = snapshots_inventory.load(instance_id=instance_id,
+                                               volumes=instance_volumes_list,
+                                               current_date=current_date,
+                                               expire_days=configuration["snapshot_expire_days"])
 
-    return snapshots_dict
+    print_debug_message("DescribeSnapshots pages fetched: {0}".format(snapshots_inventory.pages_fetched))
 
+    if inventory_cache is not None:
+        inventory_cache.put(instance_id, snapshots_index)
 
-def ec2_create_snapshot(volume_id):
+    return snapshots_index
+
+
+def ec2_snapshot_tag_specifications(snapshot_name, instance_id):
+    return [{"ResourceType": "snapshot",
+             "Tags": [{"Value": snapshot_name, "Key": "Name"},
+                      {"Value": instance_id, "Key": "InstanceId"}]}]
+
+
+def ec2_create_snapshot(volume_id, instance_id, instance_name, ec2_region, instance_report=None):
     try:
-        volume = ec2.Volume(volume_id)
-        snapshot_name = snapshot_generate_name(instance_name=current_instance_name, volume_id=volume_id)
-        snapshot = volume.create_snapshot(Description=snapshot_name)
-        snapshot.create_tags(Tags=[{"Value": snapshot_name, "Key": "Name"},
-                                   {"Value": current_instance_id, "Key": "InstanceId"}])
+        snapshot_name = snapshot_generate_name(instance_name=instance_name, volume_id=volume_id)
+        snapshot = ec2_region["client"].create_snapshot(VolumeId=volume_id,
+                                                        Description=snapshot_name,
+                                                        TagSpecifications=ec2_snapshot_tag_specifications(snapshot_name, instance_id))
 
         print_debug_message("making backup for {0}".format(volume_id))
         return snapshot
@@ -291,15 +505,904 @@ def ec2_create_snapshot(volume_id):
     except NameError as e:
         print_debug_message("Failed to created instance snapshot: {0}".format(e))
         return False
+    except botocore.exceptions.ClientError as e:
+        log_error("Failed to create snapshot for {0}: {1}".format(volume_id, e), instance_report)
+        return False
 
 
-def message_replace_macros(message_text):
+def ec2_create_instance_snapshots(instance_id, instance_name, ec2_region, instance_report=None):
+    # Crash-consistent snapshots of all instance volumes in one CreateSnapshots call
+    try:
+        snapshot_name = snapshot_generate_name(instance_name=instance_name, volume_id="multi-volume")
+        response = ec2_region["client"].create_snapshots(InstanceSpecification={"InstanceId": instance_id, "ExcludeBootVolume": False},
+                                                         Description=snapshot_name,
+                                                         TagSpecifications=ec2_snapshot_tag_specifications(snapshot_name, instance_id))
+
+        print_debug_message("making multi-volume backup for {0}".format(instance_id))
+        return response["Snapshots"]
+
+    except botocore.exceptions.ClientError as e:
+        log_error("Failed to create multi-volume snapshot for {0}: {1}".format(instance_id, e), instance_report)
+        return []
+
+
+def ec2_delete_snapshot(snapshot, ec2_region):
+    try:
+        return ec2_region["client"].delete_snapshot(SnapshotId=snapshot.id)
+    except botocore.exceptions.ClientError as e:
+        # Snapshot deleted by overlapping run or by stale inventory cache is already done
+        if e.response.get("Error", {}).get("Code") != "InvalidSnapshot.NotFound":
+            raise
+        print_debug_message("snapshot {0} already deleted".format(snapshot.id))
+
+
+def aws_session_init(region_name, profile_name="", role_arn=""):
+    if profile_name:
+        aws_session = boto3.Session(profile_name=profile_name, region_name=region_name)
+    else:
+        aws_session = boto3.Session(region_name=region_name,
+                                    aws_access_key_id=configuration["aws_key_id"],
+                                    aws_secret_access_key=configuration["aws_key_secret"])
+
+    # Cross-account target - work with temporary credentials of target account role
+    if role_arn:
+        credentials = aws_session.client("sts").assume_role(RoleArn=role_arn,
+                                                            RoleSessionName="aws-snapshot")["Credentials"]
+        aws_session = boto3.Session(region_name=region_name,
+                                    aws_access_key_id=credentials["AccessKeyId"],
+                                    aws_secret_access_key=credentials["SecretAccessKey"],
+                                    aws_session_token=credentials["SessionToken"])
+    return aws_session
+
+
+def ec2_region_init(region_name, profile_name="", role_arn=""):
+    """
+    One session, EC2 client and API throttle for every region, profile and role - reused by the whole run.
+    ec2_region = ec2_region_init('eu-west-1', profile_name='prod')
+    ec2_region["client"].describe_instances(), ec2_region["client"].create_snapshot(...) - every request is throttled
+    """
+    ec2_region_key = (region_name, profile_name, role_arn)
+
+    with ec2_regions_lock:
+        if ec2_region_key not in ec2_regions:
+            aws_session = aws_session_init(region_name=region_name, profile_name=profile_name, role_arn=role_arn)
+            # Throttled requests are retried by region throttle only, botocore retries would multiply attempts
+            ec2_region_client = aws_session.client(service_name="ec2",
+                                                   api_version=configuration["aws_api_version"],
+                                                   config=botocore.config.Config(retries={"max_attempts": 0}))
+            run_metrics.register(ec2_region_client)
+            ec2_regions[ec2_region_key] = ec2_region_add(ec2_region_client, region_name, profile_name, role_arn, aws_session)
+
+    return ec2_regions[ec2_region_key]
+
+
+def ec2_region_add(ec2_region_client, region_name, profile_name="", role_arn="", aws_session=None):
+    # Every region and account has own API rate limits
+    ec2_region_throttle = throttle.AdaptiveThrottle(rate=configuration["snapshot_api_rate"],
+                                                    max_retries=configuration["snapshot_api_retries"])
+    ec2_region_throttle.register(ec2_region_client)
+    return {"name": "{0}/{1}".format(profile_name, region_name) if profile_name else region_name,
+            "region": region_name,
+            "profile": profile_name,
+            "role_arn": role_arn,
+            "session": aws_session,
+            "service_clients": {},
+            "client": ec2_region_client,
+            "throttle": ec2_region_throttle}
+
+
+def ec2_region_service_client(ec2_region, service_name):
+    # Clients of other AWS services are created on first use and reused by the whole run
+    with ec2_regions_lock:
+        if service_name not in ec2_region["service_clients"]:
+            if ec2_region["session"] is None:
+                ec2_region["session"] = aws_session_init(region_name=ec2_region["region"],
+                                                         profile_name=ec2_region["profile"],
+                                                         role_arn=ec2_region["role_arn"])
+            service_client = ec2_region["session"].client(service_name=service_name)
+            run_metrics.register(service_client)
+            ec2_region["service_clients"][service_name] = service_client
+
+    return ec2_region["service_clients"][service_name]
+
+
+def ec2_get_regions(ec2_region):
+    if configuration["regions"] == "all":
+        response = ec2_region["client"].describe_regions(Filters=[{"Name": "opt-in-status",
+                                                                   "Values": ["opt-in-not-required", "opted-in"]}])
+        return sorted(region["RegionName"] for region in response["Regions"])
+    return configuration["regions"] or [ec2_region["region"]]
+
+
+def copy_target_name(copy_target):
+    if copy_target.get("account_id"):
+        return "{0}/{1}".format(copy_target["account_id"], copy_target["region"])
+    return copy_target["region"]
+
+
+def copy_targets_init():
+    copy_targets_dict = {}
+
+    for copy_target in configuration["snapshot_copy"]["targets"]:
+        target_name = copy_target_name(copy_target)
+        try:
+            target_ec2_region = ec2_region_init(region_name=copy_target["region"],
+                                                profile_name=copy_target.get("profile", ""),
+                                                role_arn=copy_target.get("role_arn", ""))
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            log_error("Failed connect to copy target {0}: {1}".format(target_name, e))
+            continue
+
+        copy_targets_dict[target_name] = {"region": copy_target["region"],
+                                          "account_id": copy_target.get("account_id", ""),
+                                          "kms_key_id": copy_target.get("kms_key_id", ""),
+                                          "client": target_ec2_region["client"]}
+
+    return copy_targets_dict
+
+
+def ec2_copy_snapshot(target_name, copy_job):
+    copy_target = copy_targets[target_name]
+    snapshot = copy_job["snapshot"]
+    source_ec2_region = copy_job["ec2_region"]
+    source_region = source_ec2_region["region"]
+
+    # Target account can copy only snapshots shared with it
+    if copy_target["account_id"]:
+        source_ec2_region["client"].modify_snapshot_attribute(SnapshotId=snapshot.id,
+                                                              Attribute="createVolumePermission",
+                                                              OperationType="add",
+                                                              UserIds=[copy_target["account_id"]])
+
+    copy_tags = dict(snapshot.tags)
+    copy_tags.update({"InstanceId": copy_job["instance_id"],
+                      "SourceVolumeId": snapshot.volume,
+                      "SourceSnapshotId": snapshot.id,
+                      "SourceRegion": source_region})
+    copy_params = {"SourceRegion": source_region,
+                   "SourceSnapshotId": snapshot.id,
+                   "Description": copy_tags.get("Name", snapshot.id),
+                   "TagSpecifications": [{"ResourceType": "snapshot",
+                                          "Tags": [{"Key": key, "Value": value} for key, value in sorted(copy_tags.items())]}]}
+    if copy_target["kms_key_id"]:
+        copy_params.update({"Encrypted": True, "KmsKeyId": copy_target["kms_key_id"]})
+
+    response = copy_target["client"].copy_snapshot(**copy_params)
+    print_debug_message("copying snapshot {0} to {1}: {2}".format(snapshot.id, target_name, response["SnapshotId"]))
+    return response["SnapshotId"]
+
+
+def ec2_wait_snapshot_copy(target_name, copy_snapshot_id):
+    copy_target = copy_targets[target_name]
+    copies_inventory = inventory.SnapshotInventory(ec2_client=copy_target["client"])
+    copy_waiter = snapshotwaiter.SnapshotWaiter(describe_snapshots=copies_inventory.describe_snapshot_ids,
+                                                interval=configuration["snapshot_copy"]["wait_interval"],
+                                                timeout=configuration["snapshot_copy"]["wait_timeout"])
+    return copy_waiter.wait([copy_snapshot_id])[copy_snapshot_id]["state"]
+
+
+def ec2_get_fleet_filters(fleet_filter):
+    # "tag:Backup=true,tag:Env=prod,staging" -> DescribeInstances filters, item without "=" is one more value of previous filter
+    fleet_filters = [{"Name": "instance-state-name", "Values": ["running", "stopped"]}]
+
+    for filter_expression in fleet_filter.split(","):
+        filter_expression = filter_expression.strip()
+        if "=" in filter_expression:
+            filter_name, filter_value = [part.strip() for part in filter_expression.split("=", 1)]
+            if not filter_name or not filter_value:
+                raise ValueError("wrong fleet filter: {0}".format(filter_expression))
+            fleet_filters.append({"Name": filter_name, "Values": [filter_value]})
+        elif filter_expression and len(fleet_filters) > 1:
+            fleet_filters[-1]["Values"].append(filter_expression)
+        else:
+            raise ValueError("wrong fleet filter: {0}".format(filter_expression or fleet_filter))
+
+    return fleet_filters
+
+
+def ec2_get_fleet_instances(fleet_filter, ec2_region):
+    fleet_instances = []
+    root_devices = {}
+    paginator = ec2_region["client"].get_paginator("describe_instances")
+
+    for page in metrics.paginate(paginator, Filters=ec2_get_fleet_filters(fleet_filter)):
+        for reservation in page["Reservations"]:
+            for instance in reservation["Instances"]:
+                instance_name = instance["InstanceId"]
+                for instance_tag in instance.get("Tags", []):
+                    if instance_tag["Key"] == "Name" and instance_tag["Value"]:
+                        instance_name = instance_tag["Value"]
+
+                instance_volumes_list = [mapping["Ebs"]["VolumeId"] for mapping in instance.get("BlockDeviceMappings", [])
+                                         if "Ebs" in mapping]
+                if volume_selector.volume_ids:
+                    instance_volumes_list = [volume for volume in instance_volumes_list
+                                             if volume in volume_selector.volume_ids]
+                root_devices[instance["InstanceId"]] = instance.get("RootDeviceName")
+
+                fleet_instances.append({"instance_id": instance["InstanceId"],
+                                        "instance_name": instance_name,
+                                        "ec2_region": ec2_region,
+                                        "instance_volumes_list": instance_volumes_list})
+
+    # Block devices list has no volume tags, types and sizes
+    if volume_selector.is_filtered() and fleet_instances:
+        selected_volumes = ec2_select_volumes([fleet_instance["instance_id"] for fleet_instance in fleet_instances],
+                                              ec2_region, root_devices)
+        for fleet_instance in fleet_instances:
+            fleet_instance["instance_volumes_list"] = selected_volumes[fleet_instance["instance_id"]]
+
+    return fleet_instances
+
+
+def retention_policy_init():
+    return retention.RetentionPolicy(min_count=configuration["snapshot_save_count"],
+                                     max_age_days=configuration["snapshot_expire_days"],
+                                     **configuration["snapshot_retention"])
+
+
+def snapshot_age_days(snapshot):
+    return (current_date - snapshot.start_time).days
+
+
+def snapshots_plan(instance_report):
+    retention_policy = retention_policy_init()
+    snapshots_index = instance_report["snapshots"]
+    archive_configuration = configuration["snapshot_archive"]
+    retention_plans = {}
+
+    for snapshot_volume in snapshots_index.volumes():
+        # Archived snapshots are out of normal expiry, they have own expire days
+        volume_snapshots = snapshots_index.volume_snapshots(snapshot_volume)
+        retention_plan = retention.plan_retention([snapshot for snapshot in volume_snapshots if snapshot.tier != "archive"],
+                                                  retention_policy,
+                                                  current_date)
+        for snapshot in volume_snapshots:
+            if snapshot.tier != "archive":
+                continue
+            if archive_configuration["archive_expire_days"] and snapshot_age_days(snapshot) >= archive_configuration["archive_expire_days"]:
+                retention_plan["delete"].append(snapshot)
+            else:
+                retention_plan["keep"].append((snapshot, "archive"))
+
+        # Kept snapshots past archive threshold move to archive tier, permanently restored snapshots stay in standard tier
+        retention_plan["archive"] = []
+        if archive_configuration["archive_after_days"]:
+            retention_plan["archive"] = [snapshot for snapshot, _ in retention_plan["keep"]
+                                         if snapshot.tier == "standard" and snapshot.state == "completed"
+                                         and snapshot_age_days(snapshot) >= archive_configuration["archive_after_days"]
+                                         and not instance_report["snapshots_tiering"].get(snapshot.id, "").startswith("permanent-restore")]
+        retention_plans[snapshot_volume] = retention_plan
+
+    return retention_plans
+
+
+def print_retention_plan(instance_report, retention_plans):
+    for snapshot_volume in sorted(retention_plans):
+        retention_plan = retention_plans[snapshot_volume]
+        archive_snapshots = set(retention_plan["archive"])
+        plan_lines = ["plan {0}:{1} - keep: {2}, delete: {3}, archive: {4}".format(instance_report["instance_id"],
+                                                                                  snapshot_volume,
+                                                                                  len(retention_plan["keep"]),
+                                                                                  len(retention_plan["delete"]),
+                                                                                  len(retention_plan["archive"]))]
+        plan_lines += ["  {0} {1} {2} ({3})".format("archive" if snapshot in archive_snapshots else "keep   ",
+                                                    snapshot.id, snapshot.start_time.isoformat(), keep_reason)
+                       for snapshot, keep_reason in retention_plan["keep"]]
+        plan_lines += ["  delete {0} {1}".format(snapshot.id, snapshot.start_time.isoformat())
+                       for snapshot in retention_plan["delete"]]
+        print_debug_message("\n".join(plan_lines))
+
+
+def snapshot_output_record(instance_report, snapshot, planned_action=None, action_reason=None):
+    return {"id": snapshot.id,
+            "volume": snapshot.volume,
+            "instance": snapshot.tags.get("InstanceId", instance_report["instance_id"]),
+            "region": instance_report["ec2_region"]["name"] if instance_report["ec2_region"] else None,
+            "start_time": snapshot.start_time.isoformat(),
+            "age_days": round(max(0.0, (current_date - snapshot.start_time).total_seconds() / 86400.0), 2),
+            "size": snapshot.size,
+            "state": snapshot.state,
+            "action": planned_action,
+            "reason": action_reason}
+
+
+def snapshots_export_status(instance_report, instance_volumes_list=None):
+    # Records go from API pages straight to output, inventory is not kept in memory
+    instance_volumes_list = ec2_get_snapshot_volumes(instance_report["instance_id"], instance_report["ec2_region"], instance_volumes_list)
+    instance_report["snapshots"] = snapshotindex.SnapshotIndex(volumes=instance_volumes_list)
+    instance_volumes_set = set(instance_volumes_list)
+
+    snapshots_inventory = inventory.SnapshotInventory(ec2_client=instance_report["ec2_region"]["client"])
+    for snapshot in snapshots_inventory.describe_snapshots(filters=[{"Name": "tag:InstanceId", "Values": [instance_report["instance_id"]]}]):
+        if snapshot["VolumeId"] in instance_volumes_set:
+            snapshot_writer.write(snapshot_output_record(instance_report, snapshotindex.SnapshotRecord.from_api(snapshot)))
+            instance_report["snapshots_exported"] += 1
+
+
+def snapshots_export_plan(instance_report, retention_plans):
+    for snapshot_volume in sorted(retention_plans):
+        archive_snapshots = set(retention_plans[snapshot_volume]["archive"])
+        for snapshot, keep_reason in retention_plans[snapshot_volume]["keep"]:
+            snapshot_writer.write(snapshot_output_record(instance_report, snapshot,
+                                                         "archive" if snapshot in archive_snapshots else "keep", keep_reason))
+        for snapshot in retention_plans[snapshot_volume]["delete"]:
+            snapshot_writer.write(snapshot_output_record(instance_report, snapshot, "delete", "expired"))
+        instance_report["snapshots_exported"] += len(retention_plans[snapshot_volume]["keep"]) + len(retention_plans[snapshot_volume]["delete"])
+
+
+def snapshots_delete_expired(instance_report):
+    deleted_snapshots_list = []
+
+    # Newest snapshots planned first, reserved snapshots never get into delete list
+    for retention_plan in snapshots_plan(instance_report).values():
+        deleted_snapshots_list += retention_plan["delete"]
+
+    def delete_snapshot(snapshot):
+        return ec2_delete_snapshot(snapshot, instance_report["ec2_region"])
+
+    for operation in throttle.concurrent_map(delete_snapshot, deleted_snapshots_list, configuration["snapshot_concurrency"]):
+        snapshot = operation["item"]
+        if operation["error"]:
+            log_error("Failed to delete snapshot {0}: {1}".format(snapshot.id, operation["error"]), instance_report)
+            continue
+
+        print_debug_message("deleting volume:snapshot - {0}:{1}".format(snapshot.volume, snapshot.id))
+        instance_report["snapshots_deleted"].append(snapshot.id)
+        instance_report["snapshots"].remove(snapshot.id)
+
+    if inventory_cache is not None:
+        inventory_cache.remove(instance_report["instance_id"], instance_report["snapshots_deleted"])
+
+
+def snapshots_copies_delete_expired(instance_report):
+    # Copies are expired by the same rules as local snapshots, grouped by source volume
+    retention_policy = retention_policy_init()
+
+    for target_name, copy_target in sorted(copy_targets.items()):
+        copies_inventory = inventory.SnapshotInventory(ec2_client=copy_target["client"])
+        try:
+            copies_index = copies_inventory.load(instance_id=instance_report["instance_id"],
+                                                 volumes=instance_report["snapshots"].volumes(),
+                                                 current_date=current_date,
+                                                 expire_days=configuration["snapshot_expire_days"],
+                                                 volume_tag="SourceVolumeId")
+        except botocore.exceptions.ClientError as e:
+            log_error("Failed to get snapshot copies in {0}: {1}".format(target_name, e), instance_report)
+            continue
+
+        deleted_copies_list = []
+        for copies_volume in copies_index.volumes():
+            deleted_copies_list += retention.plan_retention(copies_index.volume_snapshots(copies_volume),
+                                                            retention_policy,
+                                                            current_date)["delete"]
+
+        def delete_copy(snapshot):
+            return ec2_delete_snapshot(snapshot, copy_target)
+
+        for operation in throttle.concurrent_map(delete_copy, deleted_copies_list, configuration["snapshot_concurrency"]):
+            snapshot = operation["item"]
+            if operation["error"]:
+                log_error("Failed to delete snapshot copy {0} in {1}: {2}".format(snapshot.id, target_name, operation["error"]), instance_report)
+                continue
+            print_debug_message("deleting copy {0}:{1}:{2}".format(target_name, snapshot.volume, snapshot.id))
+            instance_report["snapshots_copies_deleted"].append("{0}:{1}".format(target_name, snapshot.id))
+
+
+def ec2_archive_snapshot(snapshot, ec2_region):
+    return ec2_region["client"].modify_snapshot_tier(SnapshotId=snapshot.id, StorageTier="archive")
+
+
+def snapshots_tiering_refresh(instance_report):
+    # Archive and restore state of all instance snapshots by one paginated call, cached tiers are updated too
+    snapshots_index = instance_report["snapshots"]
+    if not snapshots_index.volumes():
+        return
+
+    refreshed_snapshots_list = []
+    paginator = instance_report["ec2_region"]["client"].get_paginator("describe_snapshot_tier_status")
+    for page in metrics.paginate(paginator, Filters=[{"Name": "volume-id", "Values": snapshots_index.volumes()}]):
+        for tier_status in page["SnapshotTierStatuses"]:
+            snapshot = snapshots_index.get(tier_status["SnapshotId"])
+            if snapshot is None:
+                continue
+            tiering_status = tier_status.get("LastTieringOperationStatus", "")
+            if tiering_status:
+                instance_report["snapshots_tiering"][snapshot.id] = tiering_status
+            # Snapshot being archived or temporarily restored still belongs to archive
+            if tier_status.get("StorageTier") == "archive" or tiering_status.startswith(("archival-in-progress", "temporary-restore")):
+                snapshot_tier = "archive"
+            else:
+                snapshot_tier = "standard"
+            if snapshot.tier != snapshot_tier:
+                snapshot.tier = snapshot_tier
+                refreshed_snapshots_list.append(snapshot)
+
+    if inventory_cache is not None and refreshed_snapshots_list:
+        inventory_cache.update(instance_report["instance_id"], refreshed_snapshots_list)
+
+
+def snapshots_archive(instance_report):
+    archived_snapshots_list = []
+    for retention_plan in snapshots_plan(instance_report).values():
+        archived_snapshots_list += retention_plan["archive"]
+
+    def archive_snapshot(snapshot):
+        return ec2_archive_snapshot(snapshot, instance_report["ec2_region"])
+
+    for operation in throttle.concurrent_map(archive_snapshot, archived_snapshots_list, configuration["snapshot_archive"]["concurrency"]):
+        snapshot = operation["item"]
+        if operation["error"]:
+            log_error("Failed to archive snapshot {0}: {1}".format(snapshot.id, operation["error"]), instance_report)
+            continue
+
+        print_debug_message("archiving volume:snapshot - {0}:{1}".format(snapshot.volume, snapshot.id))
+        snapshot.tier = "archive"
+        instance_report["snapshots_archived"].append(snapshot.id)
+        instance_report["snapshots_tiering"][snapshot.id] = "archival-in-progress"
+        instance_report["tiers_moved_gib"]["archive"] = instance_report["tiers_moved_gib"].get("archive", 0) + snapshot.size
+
+    if inventory_cache is not None:
+        inventory_cache.update(instance_report["instance_id"],
+                               [instance_report["snapshots"].get(snapshot_id) for snapshot_id in instance_report["snapshots_archived"]])
+
+
+def snapshots_created_add(instance_report, snapshot):
+    snapshot_record = snapshotindex.SnapshotRecord.from_api(snapshot)
+    instance_report["snapshots_created"].append(snapshot_record.id)
+    instance_report["snapshots_created_records"][snapshot_record.id] = snapshot_record
+    if inventory_cache is not None:
+        inventory_cache.add(instance_report["instance_id"], snapshot_record)
+
+
+def snapshots_estimate_changes(instance_report):
+    # Volumes without previous snapshot always get new snapshot, so they are not estimated
+    snapshots_index = instance_report["snapshots"]
+    volumes_since = {}
+    for volume_id in snapshots_index.volumes():
+        volume_snapshots = [snapshot for snapshot in snapshots_index.volume_snapshots(volume_id) if snapshot.state != "error"]
+        if volume_snapshots:
+            volumes_since[volume_id] = volume_snapshots[0].start_time
+
+    if not volumes_since:
+        return
+
+    try:
+        change_estimator = changeestimate.ChangeEstimator(cloudwatch_client=ec2_region_service_client(instance_report["ec2_region"], "cloudwatch"))
+        instance_report["volumes_changed_bytes"].update(change_estimator.estimate(volumes_since, current_date))
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+        # Estimate is optional, without it all volumes are snapshotted
+        print_debug_message("Failed to estimate volumes changes for {0}: {1}".format(instance_report["instance_id"], e))
+        return
+
+    for volume_id, changed_bytes in sorted(instance_report["volumes_changed_bytes"].items()):
+        print_debug_message("volume: {0} written since last snapshot: {1}".format(volume_id,
+                                                                                 "unknown" if changed_bytes is None else "{0} bytes".format(changed_bytes)))
+
+
+def snapshot_in_progress(snapshots_index, volume_id, snapshot_name):
+    # CreateSnapshot has no ClientToken, so generated name is idempotency key of pending snapshots.
+    # Completed snapshots are not checked, snapshot_name without date would skip volume forever
+    return any(snapshot.state == "pending" and snapshot.tags.get("Name") == snapshot_name
+               for snapshot in snapshots_index.volume_snapshots(volume_id))
+
+
+def snapshots_create(instance_report):
+    if configuration["snapshot_change_estimate"] or configuration["snapshot_skip_if_unchanged"]:
+        with run_metrics.phase("estimate"):
+            snapshots_estimate_changes(instance_report)
+
+    volumes_list = instance_report["snapshots"].volumes()
+    unchanged_volumes_list = []
+    if configuration["snapshot_skip_if_unchanged"]:
+        unchanged_volumes_list = [volume_id for volume_id in volumes_list
+                                  if instance_report["volumes_changed_bytes"].get(volume_id) == 0]
+
+    if configuration["snapshot_mode"] == "multi-volume":
+        if volume_selector.select_all:
+            snapshot_name = snapshot_generate_name(instance_name=instance_report["instance_name"], volume_id="multi-volume")
+            if volumes_list and all(snapshot_in_progress(instance_report["snapshots"], volume_id, snapshot_name) for volume_id in volumes_list):
+                print_debug_message("instance: {0} snapshot {1} already in progress, skipped".format(instance_report["instance_id"], snapshot_name))
+                instance_report["snapshots_skipped"] += volumes_list
+                return
+
+            # Crash-consistent snapshots set is skipped only when no volume changed
+            if volumes_list and len(unchanged_volumes_list) == len(volumes_list):
+                print_debug_message("instance: {0} volumes unchanged since last snapshot, skipped".format(instance_report["instance_id"]))
+                instance_report["snapshots_skipped"] += unchanged_volumes_list
+                return
+
+            snapshots_list = ec2_create_instance_snapshots(instance_id=instance_report["instance_id"],
+                                                           instance_name=instance_report["instance_name"],
+                                                           ec2_region=instance_report["ec2_region"],
+                                                           instance_report=instance_report)
+            for snapshot in snapshots_list:
+                snapshots_created_add(instance_report, snapshot)
+            # One call instead of CreateSnapshot + CreateTags for every volume
+            if snapshots_list:
+                instance_report["api_calls_saved"] += 2 * len(snapshots_list) - 1
+            return
+
+        print_debug_message("multi-volume snapshot mode requires snapshot_volumes: all. Using per-volume mode")
+
+    def create_volume_snapshot(volume_id):
+        print_debug_message("volume: {0} creating snapshot".format(volume_id))
+        return ec2_create_snapshot(volume_id=volume_id,
+                                   instance_id=instance_report["instance_id"],
+                                   instance_name=instance_report["instance_name"],
+                                   ec2_region=instance_report["ec2_region"],
+                                   instance_report=instance_report)
+
+    skipped_volumes_list = []
+    for volume_id in volumes_list:
+        if volume_id in unchanged_volumes_list:
+            print_debug_message("volume: {0} unchanged since last snapshot, skipped".format(volume_id))
+        else:
+            snapshot_name = snapshot_generate_name(instance_name=instance_report["instance_name"], volume_id=volume_id)
+            if not snapshot_in_progress(instance_report["snapshots"], volume_id, snapshot_name):
+                continue
+            print_debug_message("volume: {0} snapshot {1} already in progress, skipped".format(volume_id, snapshot_name))
+        skipped_volumes_list.append(volume_id)
+    instance_report["snapshots_skipped"] += skipped_volumes_list
+
+    volumes_list = [volume_id for volume_id in volumes_list if volume_id not in skipped_volumes_list]
+    for operation in throttle.concurrent_map(create_volume_snapshot, volumes_list, configuration["snapshot_concurrency"]):
+        if operation["error"]:
+            log_error("Failed to create snapshot for {0}: {1}".format(operation["item"], operation["error"]), instance_report)
+        elif operation["result"]:
+            snapshots_created_add(instance_report, operation["result"])
+            # Tags are passed inline instead of separate CreateTags call
+            instance_report["api_calls_saved"] += 1
+
+
+def instance_report_init(instance_id, instance_name, instance_volumes_list=None, ec2_region=None):
+    return {"instance_id": instance_id,
+            "instance_name": instance_name,
+            "ec2_region": ec2_region,
+            "snapshots": snapshotindex.SnapshotIndex(volumes=instance_volumes_list or []),
+            "snapshots_created": [],
+            "snapshots_created_records": {},
+            "snapshots_skipped": [],
+            "snapshots_exported": 0,
+            "volumes_changed_bytes": {},
+            "snapshots_deleted": [],
+            "snapshots_archived": [],
+            "snapshots_tiering": {},
+            "tiers_moved_gib": {},
+            "snapshots_completion": {},
+            "snapshots_copied": [],
+            "snapshots_copies_deleted": [],
+            "api_calls_saved": 0,
+            "run_lock_holder": None,
+            "errors": []}
+
+
+def run_lock_acquire(instance_report):
+    # Lock is held until the end of run, so overlapping run never sees half updated inventory
+    if configuration["run_lock"] == "tag":
+        run_lock = runlock.TagLease(ec2_client=instance_report["ec2_region"]["client"],
+                                    resource_id=instance_report["instance_id"],
+                                    ttl=configuration["run_lock_ttl"])
+    else:
+        run_lock = runlock.FileLock(lock_directory=configuration["run_lock_location"] or configuration["state_location"],
+                                    resource_id=instance_report["instance_id"])
+
+    try:
+        run_lock_acquired = run_lock.acquire()
+    except OSError as e:
+        # Foreign or symlinked lock file is error, not silent skip
+        log_error("Failed to take run lock for {0}: {1}".format(instance_report["instance_id"], e), instance_report)
+        return False
+    if not run_lock_acquired:
+        instance_report["run_lock_holder"] = run_lock.holder
+        return False
+    run_locks.append(run_lock)
+    return True
+
+
+def run_locks_release():
+    for run_lock in run_locks:
+        try:
+            run_lock.release()
+        except (IOError, botocore.exceptions.ClientError) as e:
+            log_error("Failed to release run lock {0}: {1}".format(run_lock.owner, e))
+    del run_locks[:]
+
+
+def snapshot_instance(instance_id, instance_name, ec2_region, instance_volumes_list=None):
+    instance_report = instance_report_init(instance_id, instance_name, instance_volumes_list, ec2_region)
+
+    print_debug_message("InstanceID: {0}\nInstanceName: {1}".format(instance_id, instance_name))
+
+    try:
+        # Only actions that change snapshots take run lock
+        if configuration["run_lock"] and configuration["snapshot_action"] in ("default", "delete", "create"):
+            if not run_lock_acquire(instance_report):
+                if instance_report["run_lock_holder"]:
+                    log_warning("instance: {0} is processed by other run {1}, skipped".format(instance_id, instance_report["run_lock_holder"]))
+                return instance_report
+
+        # Snapshots actions start
+        with run_metrics.phase("inventory"):
+            if snapshot_writer is not None and configuration["snapshot_action"] == "status":
+                snapshots_export_status(instance_report, instance_volumes_list)
+            else:
+                instance_report["snapshots"] = ec2_get_instance_snapshots(instance_id, ec2_region, instance_volumes_list)
+
+        # Snapshots - print retention plan without changes
+        if configuration["snapshot_action"] == "plan":
+            if snapshot_writer is not None:
+                snapshots_export_plan(instance_report, snapshots_plan(instance_report))
+            else:
+                print_retention_plan(instance_report, snapshots_plan(instance_report))
+
+        # Snapshots - delete expired
+        if configuration["snapshot_action"] in ("default", "delete"):
+            archive_enabled = configuration["snapshot_archive"]["archive_after_days"] or configuration["snapshot_archive"]["archive_expire_days"]
+            if archive_enabled:
+                with run_metrics.phase("archive"):
+                    snapshots_tiering_refresh(instance_report)
+
+            with run_metrics.phase("delete"):
+                snapshots_delete_expired(instance_report)
+                if copy_targets:
+                    snapshots_copies_delete_expired(instance_report)
+
+            # Snapshots - move old kept snapshots to archive tier
+            if configuration["snapshot_archive"]["archive_after_days"]:
+                with run_metrics.phase("archive"):
+                    snapshots_archive(instance_report)
+
+        # Start making snapshots
+        if configuration["snapshot_action"] in ("default", "create"):
+            with run_metrics.phase("create"):
+                snapshots_create(instance_report)
+    except botocore.exceptions.ClientError as e:
+        log_error("Failed to process instance {0}: {1}".format(instance_id, e), instance_report)
+
+    return instance_report
+
+
+def snapshots_wait(ec2_region, instance_reports, on_snapshot_completed=None):
+    snapshots_reports = dict((snapshot_id, instance_report)
+                             for instance_report in instance_reports
+                             for snapshot_id in instance_report["snapshots_created"])
+    if not snapshots_reports:
+        return
+
+    snapshots_inventory = inventory.SnapshotInventory(ec2_client=ec2_region["client"])
+    snapshot_waiter = snapshotwaiter.SnapshotWaiter(describe_snapshots=snapshots_inventory.describe_snapshot_ids,
+                                                    interval=configuration["snapshot_wait_interval"],
+                                                    timeout=configuration["snapshot_wait_timeout"])
+
+    def on_snapshot_finished(snapshot_id, wait_result):
+        if on_snapshot_completed is not None and wait_result["state"] == "completed":
+            on_snapshot_completed(snapshots_reports[snapshot_id], snapshot_id)
+
+    print_debug_message("Waiting for {0} snapshots to complete in {1}".format(len(snapshots_reports), ec2_region["name"]))
+    try:
+        with run_metrics.phase("wait"):
+            wait_results = snapshot_waiter.wait(list(snapshots_reports), on_finished=on_snapshot_finished)
+    except botocore.exceptions.ClientError as e:
+        log_error("Failed to wait for snapshots: {0}".format(e))
+        return
+
+    for snapshot_id, wait_result in wait_results.items():
+        instance_report = snapshots_reports[snapshot_id]
+        instance_report["snapshots_completion"][snapshot_id] = wait_result
+        if wait_result["state"] == "pending":
+            log_error("Snapshot {0} not completed in {1} seconds".format(snapshot_id, configuration["snapshot_wait_timeout"]), instance_report)
+        elif wait_result["state"] != "completed":
+            log_error("Snapshot {0} failed with state: {1}".format(snapshot_id, wait_result["state"]), instance_report)
+        else:
+            print_debug_message("snapshot {0} completed in {1}s".format(snapshot_id, wait_result["duration"]))
+
+    print_debug_message("Snapshots wait polls: {0}".format(snapshot_waiter.polls_count))
+
+
+def snapshots_copy_submit(instance_report, snapshot_id):
+    # Completed snapshot goes to copy queue of every target right away, without waiting for other snapshots
+    snapshot = instance_report["snapshots_created_records"][snapshot_id]
+    for target_name in sorted(copy_targets):
+        copy_pipeline.submit(target_name, {"snapshot": snapshot,
+                                           "instance_id": instance_report["instance_id"],
+                                           "ec2_region": instance_report["ec2_region"],
+                                           "size": snapshot.size})
+
+
+def snapshots_copy_finish(instance_reports):
+    instance_reports_dict = dict((instance_report["instance_id"], instance_report) for instance_report in instance_reports)
+
+    with run_metrics.phase("copy"):
+        copy_results = copy_pipeline.join()
+
+    for copy_result in copy_results:
+        copy_job = copy_result["job"]
+        instance_report = instance_reports_dict[copy_job["instance_id"]]
+        if copy_result["error"]:
+            log_error("Failed to copy snapshot {0} to {1}: {2}".format(copy_job["snapshot"].id, copy_result["target"], copy_result["error"]), instance_report)
+        elif copy_result["state"] != "completed":
+            log_error("Snapshot copy {0} to {1} finished with state: {2}".format(copy_result["copy_id"], copy_result["target"], copy_result["state"]), instance_report)
+        else:
+            instance_report["snapshots_copied"].append("{0}:{1}".format(copy_result["target"], copy_result["copy_id"]))
+
+    for target_name, target_stats in sorted(copy_pipeline.stats.items()):
+        print_debug_message("Copy to {0} - copied: {1}, failed: {2}, GiB copied: {3:.1f}, "
+                            "peak in flight: {4} snapshots, {5:.1f} GiB".format(target_name,
+                                                                               target_stats["copied"],
+                                                                               target_stats["failed"],
+                                                                               target_stats["bytes_copied"] / float(copypipeline.GIB),
+                                                                               target_stats["peak_snapshots_in_flight"],
+                                                                               target_stats["peak_bytes_in_flight"] / float(copypipeline.GIB)))
+
+
+def snapshot_inventory_file(inventory_file_path):
+    instance_report = instance_report_init("offline", inventory_file_path)
+
+    try:
+        instance_report["snapshots"] = inventory.load_inventory_file(inventory_file_path,
+                                                                     current_date=current_date,
+                                                                     expire_days=configuration["snapshot_expire_days"])
+    except (IOError, ValueError, KeyError) as e:
+        log_error("Failed to load inventory file {0}: {1}".format(inventory_file_path, e), instance_report)
+        return instance_report
+
+    if snapshot_writer is not None:
+        snapshots_export_plan(instance_report, snapshots_plan(instance_report))
+    else:
+        print_retention_plan(instance_report, snapshots_plan(instance_report))
+    return instance_report
+
+
+def snapshot_fleet_instance(fleet_instance):
+    try:
+        return snapshot_instance(**fleet_instance)
+    except Exception as e:
+        instance_report = instance_report_init(**fleet_instance)
+        log_error("Failed to process instance {0}: {1}".format(fleet_instance["instance_id"], e), instance_report)
+        return instance_report
+
+
+def snapshot_fleet(fleet_filter, ec2_region):
+    with run_metrics.phase("discovery"):
+        fleet_instances = ec2_get_fleet_instances(fleet_filter, ec2_region)
+    print_debug_message("Fleet instances in {0} matched by {1}: {2}".format(ec2_region["name"], fleet_filter, len(fleet_instances)))
+
+    fleet_operations = throttle.concurrent_map(snapshot_fleet_instance, fleet_instances, configuration["fleet_concurrency"])
+
+    return [operation["result"] for operation in fleet_operations]
+
+
+def snapshot_region(sweep_region):
+    region_start = time.time()
+    ec2_region = ec2_region_init(**sweep_region)
+
+    fleet_reports = snapshot_fleet(configuration["fleet_filter"], ec2_region)
+    if configuration["snapshot_wait"] or copy_pipeline is not None:
+        snapshots_wait(ec2_region, fleet_reports, snapshots_copy_submit if copy_pipeline is not None else None)
+
+    return {"name": ec2_region["name"],
+            "reports": fleet_reports,
+            "seconds": round(time.time() - region_start, 3)}
+
+
+def snapshot_regions(default_ec2_region):
+    regions_list = ec2_get_regions(default_ec2_region)
+    sweep_regions = [{"region_name": region_name, "profile_name": profile_name}
+                     for profile_name in configuration["aws_profiles"] or [""]
+                     for region_name in regions_list]
+
+    # Regions are processed at the same time, so slow cross-region calls overlap instead of adding up
+    regions_operations = throttle.concurrent_map(snapshot_region, sweep_regions, configuration["regions_concurrency"])
+
+    fleet_reports = []
+    regions_summary = {}
+    for operation in regions_operations:
+        sweep_region = operation["item"]
+        if operation["error"]:
+            region_name = "/".join(name for name in (sweep_region["profile_name"], sweep_region["region_name"]) if name)
+            log_error("Failed to process region {0}: {1}".format(region_name, operation["error"]))
+            regions_summary[region_name] = {"seconds": None, "instances": 0, "error": str(operation["error"])}
+            continue
+
+        region_result = operation["result"]
+        print_debug_message("Region {0} processed in {1}s, instances: {2}".format(region_result["name"],
+                                                                                   region_result["seconds"],
+                                                                                   len(region_result["reports"])))
+        regions_summary[region_result["name"]] = {"seconds": region_result["seconds"],
+                                                  "instances": len(region_result["reports"]),
+                                                  "error": None}
+        fleet_reports += region_result["reports"]
+
+    return fleet_reports, regions_summary
+
+
+def report_merge(instance_reports, report_name):
+    merged_report = instance_report_init("fleet", report_name)
+
+    for instance_report in instance_reports:
+        merged_report["snapshots"].update(instance_report["snapshots"])
+        merged_report["snapshots_created"] += instance_report["snapshots_created"]
+        merged_report["snapshots_deleted"] += instance_report["snapshots_deleted"]
+        merged_report["snapshots_archived"] += instance_report["snapshots_archived"]
+        merged_report["snapshots_tiering"].update(instance_report["snapshots_tiering"])
+        for tier, moved_gib in instance_report["tiers_moved_gib"].items():
+            merged_report["tiers_moved_gib"][tier] = merged_report["tiers_moved_gib"].get(tier, 0) + moved_gib
+        merged_report["snapshots_skipped"] += instance_report["snapshots_skipped"]
+        merged_report["snapshots_exported"] += instance_report["snapshots_exported"]
+        merged_report["volumes_changed_bytes"].update(instance_report["volumes_changed_bytes"])
+        merged_report["api_calls_saved"] += instance_report["api_calls_saved"]
+        merged_report["snapshots_completion"].update(instance_report["snapshots_completion"])
+        merged_report["snapshots_copied"] += instance_report["snapshots_copied"]
+        merged_report["snapshots_copies_deleted"] += instance_report["snapshots_copies_deleted"]
+        merged_report["errors"] += instance_report["errors"]
+
+    return merged_report
+
+
+def snapshots_tiers_gib(snapshots_index):
+    # Volume size of snapshot, real stored data can be smaller
+    tiers_gib = {}
+    for snapshot in snapshots_index:
+        tiers_gib[snapshot.tier] = tiers_gib.get(snapshot.tier, 0) + snapshot.size
+    return tiers_gib
+
+
+def report_summary(instance_report):
+    snapshots_index = instance_report["snapshots"]
+    return {"instance_id": instance_report["instance_id"],
+            "instance_name": instance_report["instance_name"],
+            "region": instance_report["ec2_region"]["name"] if instance_report["ec2_region"] else None,
+            "volumes": dict((volume, snapshots_index.volume_count(volume)) for volume in snapshots_index.volumes()),
+            "snapshots_total": len(snapshots_index),
+            "snapshots_expired": snapshots_index.expired_count(),
+            "snapshots_created": instance_report["snapshots_created"],
+            "snapshots_deleted": instance_report["snapshots_deleted"],
+            "snapshots_archived": instance_report["snapshots_archived"],
+            "snapshots_tiering": instance_report["snapshots_tiering"],
+            "tiers_moved_gib": instance_report["tiers_moved_gib"],
+            "tiers_gib": snapshots_tiers_gib(snapshots_index),
+            "snapshots_skipped": instance_report["snapshots_skipped"],
+            "volumes_changed_bytes": instance_report["volumes_changed_bytes"],
+            "snapshots_completion": instance_report["snapshots_completion"],
+            "snapshots_copied": instance_report["snapshots_copied"],
+            "snapshots_copies_deleted": instance_report["snapshots_copies_deleted"],
+            "api_calls_saved": instance_report["api_calls_saved"],
+            "run_lock_holder": instance_report["run_lock_holder"],
+            "errors": instance_report["errors"]}
+
+
+def report_write(report_location, instance_reports, regions_summary=None):
+    fleet_report = {"date": current_date.isoformat(),
+                    "action": configuration["snapshot_action"],
+                    "regions": regions_summary or {},
+                    "instances": [report_summary(instance_report) for instance_report in instance_reports],
+                    "copy_targets": copy_pipeline.stats if copy_pipeline is not None else {}}
+    try:
+        with open(report_location, "w") as report_file:
+            dump(fleet_report, report_file, indent=2, sort_keys=True)
+        print_debug_message("Fleet report saved: {0}".format(report_location))
+    except IOError as e:
+        log_error("Failed to save fleet report {0}: {1}".format(report_location, e))
+
+
+def message_replace_macros(message_text, instance_report):
+    snapshots_index = instance_report["snapshots"]
     macros_dict = {"%action%": configuration["snapshot_action"],
-                   "%instance_id%": current_instance_id,
-                   "%instance_name%": current_instance_name,
-                   "%instance_volumes%": ", ".join(map(str, current_instance_snapshots_dict["snapshots_list_volumes"])),
-                   "%instance_volumes_wt%": ", ".join("{0}: {1}".format(volume, len(snapshot)) for volume, snapshot in current_instance_snapshots_dict["snapshots_list_volumes"].items()),
-                   "%instance_snapshots_total%": len(current_instance_snapshots_dict["snapshots_list_total"]),
+                   "%instance_id%": instance_report["instance_id"],
+                   "%instance_name%": instance_report["instance_name"],
+                   "%instance_volumes%": ", ".join(map(str, snapshots_index.volumes())),
+                   "%instance_volumes_wt%": ", ".join("{0}: {1}".format(volume, snapshots_index.volume_count(volume)) for volume in snapshots_index.volumes()),
+                   "%instance_snapshots_total%": len(snapshots_index),
+                   "%instance_snapshots_created%": len(instance_report["snapshots_created"]),
+                   "%instance_snapshots_skipped%": len(instance_report["snapshots_skipped"]),
+                   "%instance_changed_bytes%": sum(changed_bytes for changed_bytes in instance_report["volumes_changed_bytes"].values() if changed_bytes),
+                   "%instance_snapshots_copied%": len(instance_report["snapshots_copied"]),
+                   "%instance_snapshots_archived%": len(instance_report["snapshots_archived"]),
+                   "%instance_snapshots_completed%": len([wait_result for wait_result in instance_report["snapshots_completion"].values()
+                                                          if wait_result["state"] == "completed"]),
+                   "%instance_snapshots_wait%": ", ".join("{0}: {1} {2}s".format(snapshot_id, wait_result["state"], wait_result["duration"])
+                                                          for snapshot_id, wait_result in sorted(instance_report["snapshots_completion"].items())),
                    "%error_logs%": "\n".join(map(str, exceptions_pool))}
 
     for macro in macros_dict.keys():
@@ -308,9 +1411,9 @@ def message_replace_macros(message_text):
     return message_text
 
 
-def email_send_notifications():
-    if configuration["snapshot_action"] == "status":
-        print_debug_message("Info: Runned with status action. Email message will be not send")
+def email_send_notifications(instance_report):
+    if configuration["snapshot_action"] in ("status", "plan"):
+        print_debug_message("Info: Runned with {0} action. Email message will be not send".format(configuration["snapshot_action"]))
         return
 
     if exceptions_pool and "failure" in configuration["email_notify_on"]:
@@ -321,24 +1424,31 @@ def email_send_notifications():
         print_debug_message("Info: Email notifications disabled")
         return
 
+    # Notification modules are imported only when message is really sent
+    from libs import emailsend
     email_client = emailsend.EmailSender(email_server_config=configuration["smtp_connection"])
-    email_subject = message_replace_macros(configuration["email_message_template"][email_action]["subject"])
-    email_message = message_replace_macros(configuration["email_message_template"][email_action]["text"])
+    email_subject = message_replace_macros(configuration["email_message_template"][email_action]["subject"], instance_report)
+    email_message = message_replace_macros(configuration["email_message_template"][email_action]["text"], instance_report)
+
+    print_debug_message("Sending email message to: {0}".format(", ".join(configuration["email_users"])))
+    email_results = email_client.send_emails(email_to_list=configuration["email_users"],
+                                             email_subject=email_subject,
+                                             email_text=email_message)
+
+    for user, email_error in email_results.items():
+        if email_error:
+            log_error("Failed to send email message to {0}: {1}".format(user, email_error))
 
-    for user in configuration["email_users"]:
-        print_debug_message("Sending email message to: {0}".format(user))
-        email_client.send_email(email_to=user,
-                                email_subject=email_subject,
-                                email_text=email_message)
+    return email_results
 
 
-def slack_send_notification():
+def slack_send_notification(instance_report):
     if not configuration["slack_connection"]["api_key"] and configuration["slack_notify_on"]:
         print_debug_message("Error: Slack key does not exists")
         return
 
-    if configuration["snapshot_action"] == "status":
-        print_debug_message("Info: Runned with status action. Slack message will be not send")
+    if configuration["snapshot_action"] in ("status", "plan"):
+        print_debug_message("Info: Runned with {0} action. Slack message will be not send".format(configuration["snapshot_action"]))
         return
 
     if exceptions_pool and "failure" in configuration["slack_notify_on"]:
@@ -349,10 +1459,11 @@ def slack_send_notification():
         print_debug_message("Info: Slack notifications disabled")
         return
 
+    from libs import slacksend
     slack_client = slacksend.SlackSender(configuration["slack_connection"]["api_key"])
-    slack_title = message_replace_macros(configuration["slack_message_template"][slack_action]["title"])
-    slack_message = message_replace_macros(configuration["slack_message_template"][slack_action]["text"])
-    bot_name = message_replace_macros(configuration["slack_connection"]["bot_name"])
+    slack_title = message_replace_macros(configuration["slack_message_template"][slack_action]["title"], instance_report)
+    slack_message = message_replace_macros(configuration["slack_message_template"][slack_action]["text"], instance_report)
+    bot_name = message_replace_macros(configuration["slack_connection"]["bot_name"], instance_report)
     attachment = {"fallback": "",
                   "title": slack_title,
                   "title_link": "https://{0}.console.aws.amazon.com/console/home?region={0}".format(configuration["aws_region"]),
@@ -360,13 +1471,270 @@ def slack_send_notification():
                   "color": configuration["slack_message_template"][slack_action]["line_color"],
                   "mrkdwn_in": ["text"]}
 
-    for user in configuration["slack_users"]:
-        slack_client.send_message(channel=user,
-                                  username=bot_name,
-                                  icon_emoji=configuration["slack_message_template"][slack_action]["icon"],
-                                  attachments=[attachment])
+    print_debug_message("Sending slack message to: {0}".format(", ".join(configuration["slack_users"])))
+    slack_results = slack_client.send_messages(channels=configuration["slack_users"],
+                                               username=bot_name,
+                                               icon_emoji=configuration["slack_message_template"][slack_action]["icon"],
+                                               attachments=[attachment])
+
+    for user, slack_error in slack_results.items():
+        if slack_error:
+            log_error("Failed to send slack message to {0}: {1}".format(user, slack_error))
+
+    return slack_results
+
+
+def instance_report_anomalies(instance_report):
+    anomalies = []
+    if instance_report["run_lock_holder"]:
+        anomalies.append("skipped, processed by other run {0}".format(instance_report["run_lock_holder"]))
+    elif not instance_report["snapshots"].volumes():
+        anomalies.append("no volumes selected")
+    elif configuration["snapshot_action"] in ("default", "create") \
+            and not instance_report["snapshots_created"] and not instance_report["snapshots_skipped"]:
+        anomalies.append("no snapshots created")
+    return anomalies
+
+
+def digest_run_entry(instance_report):
+    return {"time": time.time(),
+            "action": configuration["snapshot_action"],
+            "instance_id": instance_report["instance_id"],
+            "instance_name": instance_report["instance_name"],
+            "region": instance_report["ec2_region"]["name"] if instance_report["ec2_region"] else None,
+            "snapshots_total": len(instance_report["snapshots"]),
+            "snapshots_created": len(instance_report["snapshots_created"]),
+            "snapshots_deleted": len(instance_report["snapshots_deleted"]),
+            "snapshots_skipped": len(instance_report["snapshots_skipped"]),
+            "snapshots_copied": len(instance_report["snapshots_copied"]),
+            "snapshots_archived": len(instance_report["snapshots_archived"]),
+            "errors": [str(error) for error in instance_report["errors"]],
+            "anomalies": instance_report_anomalies(instance_report)}
+
+
+def digest_build_messages(window_start, digest_runs):
+    # Successful runs are only counted, failures and anomalies are listed
+    failed_runs = [digest_run for digest_run in digest_runs if digest_run["errors"]]
+    anomaly_runs = [digest_run for digest_run in digest_runs if digest_run["anomalies"] and not digest_run["errors"]]
+    digest_action = "failure" if failed_runs else "success"
+    window_date = datetime.fromtimestamp(window_start, UTC).strftime("%Y-%m-%d %H:%M")
+
+    digest_title = "Backup digest {0}: {1} runs, {2} failed, {3} anomalies".format(window_date, len(digest_runs),
+                                                                                  len(failed_runs), len(anomaly_runs))
+    digest_lines = ["Instances: {0}".format(len(set((digest_run["region"], digest_run["instance_id"]) for digest_run in digest_runs))),
+                    "Snapshots created: {0}, deleted: {1}, skipped: {2}, copied: {3}, archived: {4}".format(sum(digest_run["snapshots_created"] for digest_run in digest_runs),
+                                                                                                         sum(digest_run["snapshots_deleted"] for digest_run in digest_runs),
+                                                                                                         sum(digest_run["snapshots_skipped"] for digest_run in digest_runs),
+                                                                                                         sum(digest_run["snapshots_copied"] for digest_run in digest_runs),
+                                                                                                         sum(digest_run.get("snapshots_archived", 0) for digest_run in digest_runs))]
+    for digest_run in failed_runs + anomaly_runs:
+        digest_lines.append("{0}:{1} {2} {3} - {4}".format(digest_run["instance_name"], digest_run["instance_id"],
+                                                           digest_run["region"] or "", digest_run["action"],
+                                                           "; ".join(digest_run["errors"] + digest_run["anomalies"])))
+    digest_text = "\n".join(digest_lines)
+
+    digest_messages = []
+    if configuration["slack_users"] and configuration["slack_connection"]["api_key"] and digest_action in configuration["slack_notify_on"]:
+        digest_messages.append({"channel": "slack", "recipients": list(configuration["slack_users"]),
+                                "action": digest_action, "title": digest_title, "text": digest_text})
+    if configuration["email_users"] and digest_action in configuration["email_notify_on"]:
+        digest_messages.append({"channel": "email", "recipients": list(configuration["email_users"]),
+                                "action": digest_action, "title": digest_title, "text": digest_text})
+    return digest_messages
+
+
+def digest_send_message(digest_message):
+    if digest_message["channel"] == "slack":
+        from libs import slacksend
+        slack_client = slacksend.SlackSender(configuration["slack_connection"]["api_key"])
+        attachment = {"fallback": "",
+                      "title": digest_message["title"],
+                      "text": digest_message["text"],
+                      "color": configuration["slack_message_template"][digest_message["action"]]["line_color"],
+                      "mrkdwn_in": ["text"]}
+        send_results = slack_client.send_messages(channels=digest_message["recipients"],
+                                                  username=configuration["slack_connection"]["bot_name"],
+                                                  icon_emoji=configuration["slack_message_template"][digest_message["action"]]["icon"],
+                                                  attachments=[attachment])
+    else:
+        from libs import emailsend
+        email_client = emailsend.EmailSender(email_server_config=configuration["smtp_connection"])
+        send_results = email_client.send_emails(email_to_list=digest_message["recipients"],
+                                                email_subject=digest_message["title"],
+                                                email_text=digest_message["text"])
+
+    for recipient, send_error in sorted(send_results.items()):
+        if send_error:
+            print_debug_message("Failed to send {0} digest to {1}, will retry: {2}".format(digest_message["channel"], recipient, send_error))
+    return sorted(recipient for recipient, send_error in send_results.items() if send_error)
+
+
+def notify_digest_flush(instance_reports):
+    # Run results are spooled, messages are sent only for closed windows and failed sends wait in spool for next flush
+    notify_spool = notifyspool.NotifySpool(spool_location=configuration["notify_digest"]["spool_location"] or
+                                           path.join(configuration["state_location"], "aws-snapshot-notify.json"),
+                                           window=configuration["notify_digest"]["window"],
+                                           retry_interval=configuration["notify_digest"]["retry_interval"],
+                                           max_attempts=configuration["notify_digest"]["max_attempts"])
+    digest_runs = [digest_run_entry(instance_report) for instance_report in instance_reports]
+
+    # Errors not bound to instance, for example failed region, are spooled as separate run
+    reported_errors = set(error for instance_report in instance_reports for error in instance_report["errors"])
+    run_errors = [error for error in exceptions_pool if error not in reported_errors]
+    if run_errors:
+        run_entry = digest_run_entry(instance_report_init("run", configuration["fleet_filter"] if configuration["fleet_enabled"] else "aws-snapshot"))
+        run_entry.update({"errors": [str(error) for error in run_errors], "anomalies": []})
+        digest_runs.append(run_entry)
+
+    try:
+        if digest_runs:
+            notify_spool.add(digest_runs)
+        flush_result = notify_spool.flush(build_messages=digest_build_messages, send_message=digest_send_message)
+    except (IOError, OSError) as e:
+        log_error("Failed to use notifications spool {0}: {1}".format(notify_spool.spool_location, e))
+        return
+
+    if flush_result["busy"]:
+        print_debug_message("Notifications spool is flushed by other run")
+        return
+    for digest_message in flush_result["dropped"]:
+        log_error("Failed to send {0} digest to {1} after {2} attempts".format(digest_message["channel"],
+                                                                               ", ".join(digest_message["recipients"]),
+                                                                               digest_message["attempts"]))
+    print_debug_message("Digest messages sent: {0}, waiting for retry: {1}".format(flush_result["sent"], flush_result["retry"]))
+
+
+def run_snapshot_action(run_configuration, run_ec2_client=None, current_instance_id=None):
+    """
+    Run configured snapshot action and return run report.
+    EC2 client and instance id can be passed to run against local EC2 stand-in without instance metadata.
+    """
+    global configuration, current_date, exceptions_pool, inventory_cache, instance_identity, run_metrics, ec2_regions, ec2_regions_lock, copy_targets, copy_pipeline, snapshot_writer, run_locks, \
+        volume_selector, volumes_selection, volumes_selection_lock
+
+    configuration = run_configuration
+    # Configuration of function call can have empty locations, like default_configuration()
+    configuration_state_locations(configuration)
+    current_date = datetime.now(UTC)
+    exceptions_pool = []
+    ec2_regions = {}
+    ec2_regions_lock = threading.Lock()
+
+    inventory_cache = None
+    run_locks = []
+    volume_selector = volumeselector.VolumeSelector(configuration["snapshot_volumes"])
+    volumes_selection = {}
+    volumes_selection_lock = threading.Lock()
+    copy_targets = {}
+    copy_pipeline = None
+    run_metrics = metrics.MetricsCollector()
+    instance_identity = instanceidentity.InstanceIdentity(cache_location=configuration["metadata_cache_location"],
+                                                          timeout=configuration["metadata_timeout"])
+
+    snapshot_writer = None
+    if configuration["output_format"] and configuration["snapshot_action"] in ("status", "plan"):
+        snapshot_writer = snapshotoutput.SnapshotWriter(output_location=configuration["output_location"],
+                                                        output_format=configuration["output_format"])
+    notify_reports = None
+    if configuration["snapshot_action"] == "notify":
+        # Only digest spool is flushed, without AWS calls
+        current_report = instance_report_init("notify", "digest")
+        notify_reports = []
+    elif configuration["inventory_file"]:
+        current_report = snapshot_inventory_file(configuration["inventory_file"])
+    else:
+        with run_metrics.phase("import"):
+            import_aws_modules()
+
+        if configuration["inventory_cache"]:
+            inventory_cache = inventorycache.InventoryCache(cache_location=configuration["inventory_cache_location"],
+                                                            ttl=configuration["inventory_cache_ttl"])
+
+        with run_metrics.phase("metadata"):
+            run_metrics.labels["region"] = ec2_get_instance_region()
+
+        if run_ec2_client is not None:
+            run_metrics.register(run_ec2_client)
+            ec2_regions[(run_metrics.labels["region"], "", "")] = ec2_region_add(run_ec2_client, run_metrics.labels["region"])
 
-        print_debug_message("Sending slack message to: {0}".format(user))
+        # Connect to AWS EC2, client is shared by all workers in region
+        try:
+            default_ec2_region = ec2_region_init(region_name=run_metrics.labels["region"])
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            log_error("Failed connect to AWS: {0}".format(e))
+            raise
+
+        if configuration["snapshot_copy"]["targets"] and configuration["snapshot_action"] in ("default", "create", "delete"):
+            copy_targets = copy_targets_init()
+
+        # Copy needs completed snapshots, so copy targets turn on waiting
+        if copy_targets and configuration["snapshot_action"] in ("default", "create"):
+            copy_pipeline = copypipeline.CopyPipeline(copy_function=ec2_copy_snapshot,
+                                                      wait_function=ec2_wait_snapshot_copy,
+                                                      max_concurrent_copies=configuration["snapshot_copy"]["max_concurrent_copies"],
+                                                      queue_size=configuration["snapshot_copy"]["queue_size"])
+
+        if configuration["fleet_enabled"]:
+            fleet_reports, regions_summary = snapshot_regions(default_ec2_region)
+            if copy_pipeline is not None:
+                snapshots_copy_finish(fleet_reports)
+            report_write(configuration["fleet_report_location"], fleet_reports, regions_summary)
+            current_report = report_merge(fleet_reports, configuration["fleet_filter"])
+            notify_reports = fleet_reports
+        else:
+            with run_metrics.phase("metadata"):
+                if current_instance_id is None:
+                    current_instance_id = ec2_get_instance_id()
+                current_instance_name = ec2_get_instance_name(current_instance_id, default_ec2_region)
+            current_report = snapshot_instance(current_instance_id, current_instance_name, default_ec2_region)
+            if configuration["snapshot_wait"] or copy_pipeline is not None:
+                snapshots_wait(default_ec2_region, [current_report], snapshots_copy_submit if copy_pipeline is not None else None)
+            if copy_pipeline is not None:
+                snapshots_copy_finish([current_report])
+
+    if snapshot_writer is not None:
+        snapshot_writer.close()
+        print_debug_message("Snapshots exported: {0}".format(snapshot_writer.records_count))
+
+    if inventory_cache is not None:
+        try:
+            inventory_cache.save()
+        except (IOError, OSError) as e:
+            log_error("Failed to save inventory cache {0}: {1}".format(configuration["inventory_cache_location"], e))
+
+    if run_locks:
+        run_locks_release()
+
+    with run_metrics.phase("notify"):
+        if configuration["snapshot_action"] == "notify" or \
+                (configuration["notify_digest"]["enabled"] and configuration["snapshot_action"] not in ("status", "plan")):
+            notify_digest_flush(notify_reports if notify_reports is not None else [current_report])
+        else:
+            slack_send_notification(current_report)
+            email_send_notifications(current_report)
+
+    if configuration["metrics_location"]:
+        try:
+            run_metrics.write(configuration["metrics_location"], metrics_format=configuration["metrics_format"])
+        except (IOError, OSError) as e:
+            log_error("Failed to save metrics {0}: {1}".format(configuration["metrics_location"], e))
+
+    # Streamed status records are not kept, so only exported count is known
+    if snapshot_writer is None or configuration["snapshot_action"] != "status":
+        print_debug_message("Snapshots total: {0}".format(len(current_report["snapshots"])))
+        print_debug_message("Snapshots expired: {0}".format(current_report["snapshots"].expired_count()))
+    if configuration["snapshot_skip_if_unchanged"]:
+        print_debug_message("Snapshots skipped as unchanged: {0}".format(len(current_report["snapshots_skipped"])))
+    for tier, moved_gib in sorted(current_report["tiers_moved_gib"].items()):
+        print_debug_message("Snapshots moved to {0} tier: {1}, GiB: {2}".format(tier, len(current_report["snapshots_archived"]), moved_gib))
+    for ec2_region in sorted(ec2_regions.values(), key=lambda ec2_region: ec2_region["name"]):
+        print_debug_message("API calls in {0}: {1}, throttled: {2}, final rate: {3:.2f} req/s".format(ec2_region["name"],
+                                                                                                   ec2_region["throttle"].calls_count,
+                                                                                                   ec2_region["throttle"].throttled_count,
+                                                                                                   ec2_region["throttle"].rate))
+    print_debug_message("API calls saved by {0} snapshot mode: {1}".format(configuration["snapshot_mode"],
+                                                                         current_report["api_calls_saved"]))
+    return current_report
 
 
 if __name__ == "__main__":
@@ -377,55 +1745,7 @@ if __name__ == "__main__":
         working_directory = path.dirname(__file__)
 
     default_config_file = "{0}/snapshot.json".format(working_directory)
-    current_date = datetime.now(UTC)
     exceptions_pool = []
     configuration = init_configuration()
-    current_instance_id = ec2_get_instance_id()
-
-    # Init AWS session
-    try:
-        aws_session = boto3.Session(region_name=ec2_get_instance_region(),
-                                    aws_access_key_id=configuration["aws_key_id"],
-                                    aws_secret_access_key=configuration["aws_key_secret"])
-    except botocore.exceptions.ClientError as e:
-        log_error("Failed connect to AWS: {0}".format(e))
-
-    # Connect to AWS EC2
-    try:
-        ec2 = aws_session.resource(service_name="ec2", api_version=configuration["aws_api_version"])
-    except:
-        log_error("Failed connect to EC2 Resource")
-
-    current_instance_name = ec2_get_instance_name(current_instance_id)
-    print_debug_message("InstanceID: {0}\nInstanceName: {1}".format(current_instance_id, current_instance_name))
-
-    # Snapshots actions start
-    current_instance_snapshots_dict = ec2_get_instance_snapshots(current_instance_id)
-
-    # Snapshots - delete expired
-    if configuration["snapshot_action"] in ("default", "delete"):
-        for snapshot_volume in current_instance_snapshots_dict['snapshots_list_volumes_expired']:
-            deleted_snapshots_list = list(current_instance_snapshots_dict['snapshots_list_volumes_expired'][snapshot_volume])
-            for snapshot_id in deleted_snapshots_list:
-                # Save reserved snapshots
-                if len(current_instance_snapshots_dict['snapshots_list_volumes'][snapshot_volume]) <= configuration["snapshot_save_count"]:
-                    print_debug_message('save reserved snapshots')
-                    break
-                snapshot_id.delete()
-                print_debug_message("deleting volume:snapshot - {0}:{1}".format(snapshot_volume, snapshot_id))
-                current_instance_snapshots_dict['snapshots_list_total'].remove(snapshot_id)
-                current_instance_snapshots_dict['snapshots_list_expired'].remove(snapshot_id)
-                current_instance_snapshots_dict['snapshots_list_volumes'][snapshot_volume].remove(snapshot_id)
-                current_instance_snapshots_dict['snapshots_list_volumes_expired'][snapshot_volume].remove(snapshot_id)
-
-    # Start making snapshots
-    if configuration["snapshot_action"] in ("default", "create"):
-        for volume_id in current_instance_snapshots_dict['snapshots_list_volumes_expired']:
-            print_debug_message("volume: {0} creating snapshot".format(volume_id))
-            snapshot_id = ec2_create_snapshot(volume_id)
-
-    slack_send_notification()
-    email_send_notifications()
-    print_debug_message("Snapshots total: {0}".format(len(current_instance_snapshots_dict['snapshots_list_total'])))
-    print_debug_message("Snapshots expired: {0}".format(len(current_instance_snapshots_dict['snapshots_list_expired'])))
-    print_debug_message("Exit")
\ No newline at end of file
+    run_snapshot_action(configuration)
+    print_debug_message("Exit")
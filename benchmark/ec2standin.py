@@ -0,0 +1,475 @@
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
+from pytz import UTC
+import bisect
+import itertools
+import threading
+import time
+
+OPERATION_NAMES = {"describe_regions": "DescribeRegions",
+                   "describe_instances": "DescribeInstances",
+                   "describe_volumes": "DescribeVolumes",
+                   "describe_snapshots": "DescribeSnapshots",
+                   "create_snapshot": "CreateSnapshot",
+                   "create_snapshots": "CreateSnapshots",
+                   "create_tags": "CreateTags",
+                   "describe_tags": "DescribeTags",
+                   "delete_tags": "DeleteTags",
+                   "copy_snapshot": "CopySnapshot",
+                   "modify_snapshot_attribute": "ModifySnapshotAttribute",
+                   "delete_snapshot": "DeleteSnapshot",
+                   "modify_snapshot_tier": "ModifySnapshotTier",
+                   "describe_snapshot_tier_status": "DescribeSnapshotTierStatus",
+                   "get_metric_data": "GetMetricData"}
+
+RESULT_KEYS = {"describe_instances": "Reservations",
+               "describe_volumes": "Volumes",
+               "describe_snapshots": "Snapshots",
+               "describe_snapshot_tier_status": "SnapshotTierStatuses"}
+
+
+class OperationModel():
+    def __init__(self, name):
+        self.name = name
+
+
+class EventEmitter():
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, event_name, handler):
+        self.handlers.setdefault(event_name, []).append(handler)
+
+    def emit(self, event_name, **kwargs):
+        return [(handler, handler(**kwargs)) for handler in self.handlers.get(event_name, [])]
+
+
+class StandInResponse():
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class ClientMeta():
+    def __init__(self, region_name):
+        self.region_name = region_name
+        self.events = EventEmitter()
+
+
+class StandInPaginator():
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        # Like botocore, MaxResults is sent only when PageSize is set
+        page_size = (PaginationConfig or {}).get("PageSize")
+        next_token = None
+        while True:
+            page_params = dict(kwargs)
+            if page_size:
+                page_params["MaxResults"] = page_size
+            if next_token:
+                page_params["NextToken"] = next_token
+            page = getattr(self.client, self.operation)(**page_params)
+            yield page
+            next_token = page.get("NextToken")
+            if not next_token:
+                break
+
+
+def tags_dict(tags):
+    return dict((tag["Key"], tag["Value"]) for tag in tags or [])
+
+
+def match_filters(resource, filters, attributes):
+    for resource_filter in filters or []:
+        filter_name = resource_filter["Name"]
+        if filter_name.startswith("tag:"):
+            resource_value = tags_dict(resource.get("Tags")).get(filter_name[4:])
+            resource_values = [resource_value] if resource_value is not None else []
+        else:
+            resource_values = attributes(resource).get(filter_name, [])
+        # Filter values can have * and ? wildcards, like in EC2
+        if not any(fnmatchcase(str(value), str(filter_value)) for filter_value in resource_filter["Values"] for value in resource_values):
+            return False
+    return True
+
+
+class StandInClient():
+    def api_call(self, operation, params, function):
+        operation_model = OperationModel(OPERATION_NAMES[operation])
+        call_context = {}
+        self.meta.events.emit("before-call", model=operation_model, params=params, context=call_context)
+        attempts = 0
+        while True:
+            # Like botocore endpoint: before-send for every attempt, needs-retry handlers return seconds to sleep
+            attempts += 1
+            self.meta.events.emit("before-send", request=None)
+            with self.lock:
+                self.calls[operation_model.name] = self.calls.get(operation_model.name, 0) + 1
+            if self.api_latency:
+                time.sleep(self.api_latency)
+            try:
+                with self.lock:
+                    response = function(**params)
+                http_response = StandInResponse(200)
+            except ClientError as e:
+                response = e.response
+                http_response = StandInResponse(e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 400))
+            response["ResponseMetadata"] = {"HTTPStatusCode": http_response.status_code, "RetryAttempts": attempts - 1}
+
+            retry_delays = [retry_delay for _, retry_delay in self.meta.events.emit("needs-retry",
+                                                                                     response=(http_response, response),
+                                                                                     operation=operation_model,
+                                                                                     attempts=attempts,
+                                                                                     caught_exception=None)
+                            if retry_delay is not None]
+            if not retry_delays:
+                break
+            time.sleep(retry_delays[0])
+
+        self.meta.events.emit("after-call", model=operation_model, parsed=response, context=call_context)
+        if "Error" in response:
+            raise ClientError(response, operation_model.name)
+        return response
+
+    @staticmethod
+    def client_error(operation, code, message):
+        return ClientError({"Error": {"Code": code, "Message": message}}, OPERATION_NAMES[operation])
+
+
+class EC2StandIn(StandInClient):
+    """
+    Local EC2 stand-in with operations used by aws-snapshot. Every call is counted and emits
+    botocore-like before-call\\before-send\\needs-retry\\after-call events, so metrics collector and throttle work with it too.
+    ec2_client = EC2StandIn()
+    ec2_client.add_instance('i-benchmark', volumes_count=10, snapshots_count=1000)
+    ec2_client.calls - {"DescribeSnapshots": 1, ...}
+    Stand-ins sharing one regions dict can copy snapshots between each other:
+    ec2_regions = {}
+    EC2StandIn('us-east-1', regions=ec2_regions), EC2StandIn('eu-west-1', regions=ec2_regions)
+    """
+    def __init__(self, region_name="us-east-1", api_latency=0.0, regions=None):
+        self.meta = ClientMeta(region_name)
+        self.regions = regions if regions is not None else {}
+        self.regions[region_name] = self
+        self.api_latency = api_latency
+        self.lock = threading.RLock()
+        self.instances = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.calls = {}
+        self.query_cache = {}
+        self.volume_writes = {}
+        self.resource_ids = itertools.count(1)
+
+    def get_paginator(self, operation):
+        return StandInPaginator(self, operation)
+
+    def new_id(self, prefix):
+        return "{0}-{1:017x}".format(prefix, next(self.resource_ids))
+
+    def add_instance(self, instance_id, volumes_count=1, snapshots_count=0, max_age_days=60, tags=None):
+        current_date = datetime.now(UTC)
+        with self.lock:
+            self.instances[instance_id] = {"InstanceId": instance_id,
+                                           "State": {"Name": "running"},
+                                           "RootDeviceName": "/dev/xvda",
+                                           "Tags": [{"Key": "Name", "Value": instance_id}] + list(tags or []),
+                                           "BlockDeviceMappings": []}
+            volumes_list = []
+            for volume_position in range(volumes_count):
+                volume_id = self.new_id("vol")
+                device_name = "/dev/xvd{0}".format(chr(ord("a") + volume_position % 26))
+                self.volumes[volume_id] = {"VolumeId": volume_id,
+                                           "Size": 8 + volume_position % 4 * 100,
+                                           "VolumeType": "gp2" if volume_position % 2 else "gp3",
+                                           "State": "in-use",
+                                           "Tags": [],
+                                           "Attachments": [{"InstanceId": instance_id, "Device": device_name, "State": "attached"}]}
+                self.instances[instance_id]["BlockDeviceMappings"].append({"DeviceName": device_name,
+                                                                           "Ebs": {"VolumeId": volume_id}})
+                volumes_list.append(volume_id)
+
+            # Snapshots spread evenly over volumes and max_age_days
+            for snapshot_position in range(snapshots_count):
+                volume_id = volumes_list[snapshot_position % len(volumes_list)]
+                snapshot_age = timedelta(seconds=max_age_days * 86400.0 * snapshot_position / max(1, snapshots_count))
+                self.add_snapshot(volume_id, instance_id, current_date - snapshot_age, state="completed")
+            self.query_cache = {}
+
+        return volumes_list
+
+    def write_volume(self, volume_id, write_bytes, write_time=None):
+        self.volume_writes.setdefault(volume_id, []).append((write_time or datetime.now(UTC), write_bytes))
+
+    def add_snapshot(self, volume_id, instance_id, start_time, state="pending", tags=None, volume_size=None):
+        snapshot_id = self.new_id("snap")
+        if volume_size is None:
+            volume_size = self.volumes[volume_id]["Size"]
+        self.snapshots[snapshot_id] = {"SnapshotId": snapshot_id,
+                                       "VolumeId": volume_id,
+                                       "VolumeSize": volume_size,
+                                       "StartTime": start_time,
+                                       "State": state,
+                                       "OwnerId": "000000000000",
+                                       "StorageTier": "standard",
+                                       "Tags": tags or [{"Key": "InstanceId", "Value": instance_id}]}
+        self.query_cache = {}
+        return self.snapshots[snapshot_id]
+
+    def paginate_result(self, operation, items, items_ids, MaxResults=None, NextToken=None):
+        # Items are sorted by id and NextToken is the last returned id, so pages stay stable while items change
+        page_start = bisect.bisect_right(items_ids, NextToken) if NextToken else 0
+        page_end = len(items) if not MaxResults else page_start + MaxResults
+        response = {RESULT_KEYS[operation]: items[page_start:page_end]}
+        if page_end < len(items):
+            response["NextToken"] = items_ids[page_end - 1]
+        return response
+
+    def query(self, query_key, resources, resource_id_key, filters, attributes):
+        # Filtered result is cached between pages until something changes
+        if query_key not in self.query_cache:
+            resources_filtered = [resource for resource in resources() if match_filters(resource, filters, attributes)]
+            self.query_cache[query_key] = (resources_filtered, [resource[resource_id_key] for resource in resources_filtered])
+        return self.query_cache[query_key]
+
+    def describe_regions(self, **params):
+        def describe(Filters=None, **kwargs):
+            return {"Regions": [{"RegionName": region_name, "OptInStatus": "opt-in-not-required"}
+                                for region_name in sorted(self.regions)]}
+        return self.api_call("describe_regions", params, describe)
+
+    def describe_instances(self, **params):
+        def describe(InstanceIds=None, Filters=None, MaxResults=None, NextToken=None):
+            instances = [self.instances[instance_id] for instance_id in sorted(self.instances)
+                         if not InstanceIds or instance_id in InstanceIds]
+            instances = [instance for instance in instances
+                         if match_filters(instance, Filters, lambda instance: {"instance-id": [instance["InstanceId"]],
+                                                                               "instance-state-name": [instance["State"]["Name"]]})]
+            reservations = [{"Instances": [dict(instance)]} for instance in instances]
+            return self.paginate_result("describe_instances", reservations, [instance["InstanceId"] for instance in instances],
+                                        MaxResults, NextToken)
+        return self.api_call("describe_instances", params, describe)
+
+    def describe_volumes(self, **params):
+        def describe(VolumeIds=None, Filters=None, MaxResults=None, NextToken=None):
+            for volume_id in VolumeIds or []:
+                if volume_id not in self.volumes:
+                    raise self.client_error("describe_volumes", "InvalidVolume.NotFound", volume_id)
+            volumes = [self.volumes[volume_id] for volume_id in sorted(self.volumes) if not VolumeIds or volume_id in VolumeIds]
+            volumes = [dict(volume) for volume in volumes
+                       if match_filters(volume, Filters, lambda volume: {"volume-id": [volume["VolumeId"]],
+                                                                         "volume-type": [volume["VolumeType"]],
+                                                                         "size": [volume["Size"]],
+                                                                         "status": [volume["State"]],
+                                                                         "attachment.instance-id": [attachment["InstanceId"] for attachment in volume["Attachments"]],
+                                                                         "attachment.device": [attachment["Device"] for attachment in volume["Attachments"]]})]
+            return self.paginate_result("describe_volumes", volumes, [volume["VolumeId"] for volume in volumes],
+                                        MaxResults, NextToken)
+        return self.api_call("describe_volumes", params, describe)
+
+    def describe_snapshots(self, **params):
+        def describe(SnapshotIds=None, OwnerIds=None, Filters=None, MaxResults=None, NextToken=None):
+            if SnapshotIds:
+                for snapshot_id in SnapshotIds:
+                    if snapshot_id not in self.snapshots:
+                        raise self.client_error("describe_snapshots", "InvalidSnapshot.NotFound", snapshot_id)
+                snapshots = [dict(self.snapshots[snapshot_id]) for snapshot_id in SnapshotIds]
+                # Pending snapshots are completed on the next poll
+                for snapshot_id in SnapshotIds:
+                    self.snapshots[snapshot_id]["State"] = "completed"
+                return {"Snapshots": snapshots}
+
+            query_key = ("describe_snapshots", repr(Filters))
+            snapshots, snapshots_ids = self.query(query_key,
+                                                  lambda: [self.snapshots[snapshot_id] for snapshot_id in sorted(self.snapshots)],
+                                                  "SnapshotId",
+                                                  Filters,
+                                                  lambda snapshot: {"volume-id": [snapshot["VolumeId"]],
+                                                                    "snapshot-id": [snapshot["SnapshotId"]],
+                                                                    "status": [snapshot["State"]]})
+            response = self.paginate_result("describe_snapshots", snapshots, snapshots_ids, MaxResults, NextToken)
+            response["Snapshots"] = [dict(snapshot) for snapshot in response["Snapshots"]]
+            return response
+        return self.api_call("describe_snapshots", params, describe)
+
+    def create_snapshot(self, **params):
+        def create(VolumeId, Description="", TagSpecifications=None, **kwargs):
+            if VolumeId not in self.volumes:
+                raise self.client_error("create_snapshot", "InvalidVolume.NotFound", VolumeId)
+            snapshot_tags = [tag for tag_specification in TagSpecifications or [] for tag in tag_specification["Tags"]]
+            snapshot = self.add_snapshot(VolumeId, None, datetime.now(UTC), tags=snapshot_tags)
+            snapshot["Description"] = Description
+            return dict(snapshot)
+        return self.api_call("create_snapshot", params, create)
+
+    def create_snapshots(self, **params):
+        def create(InstanceSpecification, Description="", TagSpecifications=None, **kwargs):
+            instance_id = InstanceSpecification["InstanceId"]
+            if instance_id not in self.instances:
+                raise self.client_error("create_snapshots", "InvalidInstanceID.NotFound", instance_id)
+            snapshot_tags = [tag for tag_specification in TagSpecifications or [] for tag in tag_specification["Tags"]]
+            snapshots = []
+            for block_device in self.instances[instance_id]["BlockDeviceMappings"]:
+                snapshot = self.add_snapshot(block_device["Ebs"]["VolumeId"], instance_id, datetime.now(UTC), tags=snapshot_tags)
+                snapshot["Description"] = Description
+                snapshots.append(dict(snapshot))
+            return {"Snapshots": snapshots}
+        return self.api_call("create_snapshots", params, create)
+
+    def tagged_resource(self, resource_id):
+        for resources in (self.snapshots, self.instances, self.volumes):
+            if resource_id in resources:
+                return resources[resource_id]
+        return None
+
+    def create_tags(self, **params):
+        def create(Resources, Tags):
+            for resource_id in Resources:
+                resource = self.tagged_resource(resource_id)
+                if resource is not None:
+                    resource_tags = tags_dict(resource["Tags"])
+                    resource_tags.update(tags_dict(Tags))
+                    resource["Tags"] = [{"Key": key, "Value": value} for key, value in resource_tags.items()]
+            self.query_cache = {}
+            return {}
+        return self.api_call("create_tags", params, create)
+
+    def describe_tags(self, **params):
+        def describe(Filters=None, **kwargs):
+            filter_values = dict((resource_filter["Name"], resource_filter["Values"]) for resource_filter in Filters or [])
+            resource_tags = []
+            for resource_id in filter_values.get("resource-id", []):
+                resource = self.tagged_resource(resource_id)
+                for tag in resource["Tags"] if resource is not None else []:
+                    if "key" not in filter_values or tag["Key"] in filter_values["key"]:
+                        resource_tags.append({"ResourceId": resource_id, "Key": tag["Key"], "Value": tag["Value"]})
+            return {"Tags": resource_tags}
+        return self.api_call("describe_tags", params, describe)
+
+    def delete_tags(self, **params):
+        def delete(Resources, Tags):
+            for resource_id in Resources:
+                resource = self.tagged_resource(resource_id)
+                if resource is not None:
+                    # Tag with value is deleted only when value matches, like in EC2
+                    resource["Tags"] = [tag for tag in resource["Tags"]
+                                        if not any(tag["Key"] == delete_tag["Key"] and delete_tag.get("Value", tag["Value"]) == tag["Value"]
+                                                   for delete_tag in Tags)]
+            self.query_cache = {}
+            return {}
+        return self.api_call("delete_tags", params, delete)
+
+    def copy_snapshot(self, **params):
+        def copy(SourceRegion, SourceSnapshotId, Description="", TagSpecifications=None, **kwargs):
+            source_client = self.regions.get(SourceRegion)
+            if source_client is None or SourceSnapshotId not in source_client.snapshots:
+                raise self.client_error("copy_snapshot", "InvalidSnapshot.NotFound", SourceSnapshotId)
+            snapshot_tags = [tag for tag_specification in TagSpecifications or [] for tag in tag_specification["Tags"]]
+            # Copied snapshots always have fake volume id
+            snapshot = self.add_snapshot("vol-ffffffff", None, datetime.now(UTC), tags=snapshot_tags,
+                                         volume_size=source_client.snapshots[SourceSnapshotId]["VolumeSize"])
+            snapshot["Description"] = Description
+            return {"SnapshotId": snapshot["SnapshotId"]}
+        return self.api_call("copy_snapshot", params, copy)
+
+    def modify_snapshot_attribute(self, **params):
+        def modify(SnapshotId, **kwargs):
+            if SnapshotId not in self.snapshots:
+                raise self.client_error("modify_snapshot_attribute", "InvalidSnapshot.NotFound", SnapshotId)
+            return {}
+        return self.api_call("modify_snapshot_attribute", params, modify)
+
+    def modify_snapshot_tier(self, **params):
+        def modify(SnapshotId, StorageTier="archive"):
+            if SnapshotId not in self.snapshots:
+                raise self.client_error("modify_snapshot_tier", "InvalidSnapshot.NotFound", SnapshotId)
+            snapshot = self.snapshots[SnapshotId]
+            if snapshot["State"] != "completed" or snapshot["StorageTier"] == "archive" or "TieringStatus" in snapshot:
+                raise self.client_error("modify_snapshot_tier", "IncorrectState", SnapshotId)
+            snapshot["TieringStatus"] = "archival-in-progress"
+            self.query_cache = {}
+            return {"SnapshotId": SnapshotId, "TieringStartTime": datetime.now(UTC)}
+        return self.api_call("modify_snapshot_tier", params, modify)
+
+    def describe_snapshot_tier_status(self, **params):
+        def describe(Filters=None, MaxResults=None, NextToken=None):
+            query_key = ("describe_snapshot_tier_status", repr(Filters))
+            snapshots, snapshots_ids = self.query(query_key,
+                                                  lambda: [self.snapshots[snapshot_id] for snapshot_id in sorted(self.snapshots)],
+                                                  "SnapshotId",
+                                                  Filters,
+                                                  lambda snapshot: {"volume-id": [snapshot["VolumeId"]],
+                                                                    "snapshot-id": [snapshot["SnapshotId"]]})
+            response = self.paginate_result("describe_snapshot_tier_status", snapshots, snapshots_ids, MaxResults, NextToken)
+            tier_statuses = []
+            for snapshot in response["SnapshotTierStatuses"]:
+                tier_status = {"SnapshotId": snapshot["SnapshotId"],
+                               "VolumeId": snapshot["VolumeId"],
+                               "Status": snapshot["State"],
+                               "StorageTier": snapshot["StorageTier"]}
+                if "TieringStatus" in snapshot:
+                    tier_status["LastTieringOperationStatus"] = snapshot["TieringStatus"]
+                    # Archival in progress is completed on the next call
+                    if snapshot["TieringStatus"] == "archival-in-progress":
+                        snapshot["TieringStatus"] = "archival-completed"
+                        snapshot["StorageTier"] = "archive"
+                tier_statuses.append(tier_status)
+            response["SnapshotTierStatuses"] = tier_statuses
+            return response
+        return self.api_call("describe_snapshot_tier_status", params, describe)
+
+    def delete_snapshot(self, **params):
+        def delete(SnapshotId):
+            if SnapshotId not in self.snapshots:
+                raise self.client_error("delete_snapshot", "InvalidSnapshot.NotFound", SnapshotId)
+            del self.snapshots[SnapshotId]
+            self.query_cache = {}
+            return {}
+        return self.api_call("delete_snapshot", params, delete)
+
+
+class CloudWatchStandIn(StandInClient):
+    """
+    CloudWatch stand-in with VolumeWriteBytes of EC2 stand-in volumes, written by ec2_client.write_volume().
+    Like CloudWatch, periods without writes have no datapoints and periods ended less than ingestion_delay ago
+    are not returned yet. With idle_datapoints=True idle periods report zero instead.
+    cloudwatch_client = CloudWatchStandIn(ec2_client, ingestion_delay=timedelta(minutes=5))
+    """
+    def __init__(self, ec2_client, api_latency=0.0, ingestion_delay=timedelta(minutes=5), idle_datapoints=False):
+        self.ec2_client = ec2_client
+        self.meta = ClientMeta(ec2_client.meta.region_name)
+        self.api_latency = api_latency
+        self.ingestion_delay = ingestion_delay
+        self.idle_datapoints = idle_datapoints
+        self.lock = threading.RLock()
+        self.calls = {}
+
+    def get_metric_data(self, **params):
+        def get(MetricDataQueries, StartTime, EndTime, **kwargs):
+            metric_results = []
+            ingested_until = min(EndTime, datetime.now(UTC) - self.ingestion_delay)
+            for metric_query in MetricDataQueries:
+                metric_stat = metric_query["MetricStat"]
+                volume_id = metric_stat["Metric"]["Dimensions"][0]["Value"]
+                period = timedelta(seconds=metric_stat["Period"])
+                volume_writes = self.ec2_client.volume_writes.get(volume_id, [])
+                timestamps, values = [], []
+                if volume_id in self.ec2_client.volumes:
+                    period_start = StartTime
+                    while period_start + period <= ingested_until:
+                        period_bytes = sum(write_bytes for write_time, write_bytes in volume_writes
+                                           if period_start <= write_time < period_start + period)
+                        if period_bytes or self.idle_datapoints:
+                            timestamps.append(period_start)
+                            values.append(float(period_bytes))
+                        period_start += period
+                metric_results.append({"Id": metric_query["Id"],
+                                       "Label": metric_stat["Metric"]["MetricName"],
+                                       "Timestamps": timestamps,
+                                       "Values": values,
+                                       "StatusCode": "Complete"})
+            return {"MetricDataResults": metric_results}
+        return self.api_call("get_metric_data", params, get)
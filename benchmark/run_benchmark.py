@@ -0,0 +1,188 @@
+"""
+Offline benchmark for aws-snapshot against local EC2 stand-in.
+Every scenario runs in separate process, so peak memory is measured for one run only.
+
+Usage:
+run_benchmark.py - run all scenarios and compare with baseline
+run_benchmark.py --update - run all scenarios and save results as new baseline
+run_benchmark.py --scenarios=10x1000,500x100000 --actions=status,default
+"""
+from json import dump, dumps, load, loads
+from os import devnull, path
+import subprocess
+import resource
+import shutil
+import tempfile
+import logging
+import getopt
+import time
+import imp
+import sys
+
+benchmark_directory = path.dirname(path.abspath(__file__))
+repository_directory = path.dirname(benchmark_directory)
+sys.path.insert(0, repository_directory)
+sys.path.insert(0, benchmark_directory)
+
+DEFAULT_SCENARIOS = "1x10,10x1000,100x10000,500x100000"
+DEFAULT_ACTIONS = "status,delete,create,default"
+DEFAULT_BASELINE = path.join(benchmark_directory, "baseline.json")
+BENCHMARK_INSTANCE_ID = "i-0benchmark"
+
+
+def show_help():
+    print (__doc__)
+    sys.exit(0)
+
+
+def run_scenario(scenario, action):
+    import ec2standin
+    aws_snapshot = imp.load_source("aws_snapshot", path.join(repository_directory, "aws-snapshot.py"))
+    logging.basicConfig(filename=devnull, level=logging.INFO)
+
+    volumes_count, snapshots_count = [int(scenario_value) for scenario_value in scenario.split("x")]
+    ec2_client = ec2standin.EC2StandIn()
+    ec2_client.add_instance(BENCHMARK_INSTANCE_ID, volumes_count=volumes_count, snapshots_count=snapshots_count)
+
+    state_location = tempfile.mkdtemp()
+    configuration = aws_snapshot.default_configuration()
+    configuration.update({"aws_region": ec2_client.meta.region_name,
+                          "snapshot_action": action,
+                          "snapshot_api_rate": 1000000,
+                          "inventory_cache": False,
+                          "state_location": state_location})
+
+    # SDK import is one-time process cost, it is kept out of measured run like in baseline
+    aws_snapshot.import_aws_modules()
+
+    run_start = time.time()
+    run_report = aws_snapshot.run_snapshot_action(configuration,
+                                                  run_ec2_client=ec2_client,
+                                                  current_instance_id=BENCHMARK_INSTANCE_ID)
+    run_time = time.time() - run_start
+    shutil.rmtree(state_location)
+
+    return {"api_calls": ec2_client.calls,
+            "api_calls_total": sum(ec2_client.calls.values()),
+            "wall_time": round(run_time, 3),
+            # ru_maxrss is in kilobytes on Linux
+            "peak_memory_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+            "snapshots_total": len(run_report["snapshots"]),
+            "snapshots_deleted": len(run_report["snapshots_deleted"]),
+            "snapshots_created": len(run_report["snapshots_created"])}
+
+
+def sdk_versions():
+    # Time and memory depend on SDK, so baseline of other SDK is not comparable
+    import boto3
+    import botocore
+    return {"python": "{0}.{1}.{2}".format(*sys.version_info[:3]),
+            "boto3": getattr(boto3, "__version__", "unknown"),
+            "botocore": getattr(botocore, "__version__", "unknown")}
+
+
+def run_scenario_process(scenario, action):
+    scenario_output = subprocess.check_output([sys.executable,
+                                               path.abspath(__file__),
+                                               "--run_scenario={0}:{1}".format(scenario, action)])
+    return loads(scenario_output.decode("utf-8").strip().splitlines()[-1])
+
+
+def compare_results(benchmark_results, baseline_results, time_tolerance, compare_resources=True):
+    regressions = []
+    for scenario_name in sorted(benchmark_results):
+        if scenario_name not in baseline_results:
+            continue
+        scenario_result = benchmark_results[scenario_name]
+        scenario_baseline = baseline_results[scenario_name]
+
+        if scenario_result["api_calls_total"] > scenario_baseline["api_calls_total"]:
+            regressions.append("{0}: api calls {1} > {2}".format(scenario_name,
+                                                                 scenario_result["api_calls_total"],
+                                                                 scenario_baseline["api_calls_total"]))
+        if not compare_resources:
+            continue
+        # Small absolute slack, so milliseconds runs are not flaky
+        if scenario_result["wall_time"] > scenario_baseline["wall_time"] * (1 + time_tolerance) + 0.1:
+            regressions.append("{0}: wall time {1}s > {2}s".format(scenario_name,
+                                                                   scenario_result["wall_time"],
+                                                                   scenario_baseline["wall_time"]))
+        if scenario_result["peak_memory_mb"] > scenario_baseline["peak_memory_mb"] * (1 + time_tolerance) + 5:
+            regressions.append("{0}: peak memory {1}MB > {2}MB".format(scenario_name,
+                                                                      scenario_result["peak_memory_mb"],
+                                                                      scenario_baseline["peak_memory_mb"]))
+    return regressions
+
+
+def main():
+    scenarios = DEFAULT_SCENARIOS
+    actions = DEFAULT_ACTIONS
+    baseline_location = DEFAULT_BASELINE
+    update_baseline = False
+    time_tolerance = 0.5
+
+    try:
+        cmd_options, cmd_arguments = getopt.getopt(sys.argv[1:], "h", ["help",
+                                                                      "update",
+                                                                      "scenarios=",
+                                                                      "actions=",
+                                                                      "baseline=",
+                                                                      "tolerance=",
+                                                                      "run_scenario="])
+    except getopt.GetoptError:
+        show_help()
+
+    for cmd_opt, cmd_arg in cmd_options:
+        if cmd_opt in ("-h", "--help"):
+            show_help()
+        elif cmd_opt == "--run_scenario":
+            scenario, action = cmd_arg.split(":")
+            print (dumps(run_scenario(scenario, action), sort_keys=True))
+            return 0
+        elif cmd_opt == "--update":
+            update_baseline = True
+        elif cmd_opt == "--scenarios":
+            scenarios = cmd_arg
+        elif cmd_opt == "--actions":
+            actions = cmd_arg
+        elif cmd_opt == "--baseline":
+            baseline_location = cmd_arg
+        elif cmd_opt == "--tolerance":
+            time_tolerance = float(cmd_arg)
+
+    benchmark_results = {}
+    for scenario in scenarios.split(","):
+        for action in actions.split(","):
+            scenario_name = "{0}:{1}".format(scenario, action)
+            benchmark_results[scenario_name] = run_scenario_process(scenario, action)
+            print ("{0:<20} calls: {1:>7} time: {2:>8.3f}s memory: {3:>7.1f}MB".format(scenario_name,
+                                                                                     benchmark_results[scenario_name]["api_calls_total"],
+                                                                                     benchmark_results[scenario_name]["wall_time"],
+                                                                                     benchmark_results[scenario_name]["peak_memory_mb"]))
+
+    benchmark_sdk = sdk_versions()
+    if update_baseline:
+        with open(baseline_location, "w") as baseline_file:
+            dump({"sdk": benchmark_sdk, "scenarios": benchmark_results}, baseline_file, indent=2, sort_keys=True)
+        print ("Baseline saved: {0}".format(baseline_location))
+        return 0
+
+    if not path.exists(baseline_location):
+        print ("Baseline not found: {0}, run with --update".format(baseline_location))
+        return 1
+
+    with open(baseline_location) as baseline_file:
+        baseline = load(baseline_file)
+
+    compare_resources = baseline.get("sdk") == benchmark_sdk
+    if not compare_resources:
+        print ("Baseline SDK {0} differs from {1}, only API calls are compared. "
+               "Install baseline SDK or run with --update".format(baseline.get("sdk"), benchmark_sdk))
+    regressions = compare_results(benchmark_results, baseline["scenarios"], time_tolerance, compare_resources)
+    for regression in regressions:
+        print ("Regression: {0}".format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+from datetime import timedelta
+
+METRICS_BATCH_SIZE = 500
+# EBS datapoints get to CloudWatch with a few minutes delay
+INGESTION_DELAY = timedelta(minutes=10)
+
+
+def metric_period(since_date, current_date):
+    # CloudWatch keeps 5 minutes datapoints for 15 days, hourly after that
+    if current_date - since_date <= timedelta(days=15):
+        return 300
+    return 3600
+
+
+class ChangeEstimator():
+    """
+    Estimate of bytes written to volumes since their last snapshot, from CloudWatch VolumeWriteBytes.
+    All volumes are queried together by GetMetricData, up to 500 volumes per call.
+    change_estimator = ChangeEstimator(cloudwatch_client=cloudwatch)
+    change_estimator.estimate({'vol-xxx': last_snapshot_start_time}, current_date=datetime.now(UTC))
+    returns {"vol-xxx": 1048576} - None when CloudWatch has no datapoint for the last period before INGESTION_DELAY,
+    idle volumes can have no datapoints at all. Rewritten blocks are counted every time, but writes of the last
+    minutes that are not in CloudWatch yet are not seen, so zero estimate means no writes until the last datapoint.
+    """
+    def __init__(self, cloudwatch_client, batch_size=METRICS_BATCH_SIZE):
+        self.cloudwatch_client = cloudwatch_client
+        self.batch_size = batch_size
+        self.calls_count = 0
+
+    def estimate(self, volumes_since, current_date):
+        changed_bytes = dict((volume_id, None) for volume_id in volumes_since)
+        # Volumes with close last snapshot time share one time range
+        volumes_list = sorted(volumes_since, key=lambda volume_id: volumes_since[volume_id])
+
+        for batch_start in range(0, len(volumes_list), self.batch_size):
+            batch_volumes = volumes_list[batch_start:batch_start + self.batch_size]
+            batch_since = volumes_since[batch_volumes[0]]
+            period = metric_period(batch_since, current_date)
+            metric_queries = [{"Id": "v{0}".format(volume_position),
+                               "MetricStat": {"Metric": {"Namespace": "AWS/EBS",
+                                                         "MetricName": "VolumeWriteBytes",
+                                                         "Dimensions": [{"Name": "VolumeId", "Value": volume_id}]},
+                                              "Period": period,
+                                              "Stat": "Sum"},
+                               "ReturnData": True}
+                              for volume_position, volume_id in enumerate(batch_volumes)]
+
+            metric_params = {"MetricDataQueries": metric_queries,
+                             "StartTime": batch_since - timedelta(seconds=period),
+                             "EndTime": current_date,
+                             "ScanBy": "TimestampAscending"}
+            last_timestamps = {}
+            while True:
+                self.calls_count += 1
+                response = self.cloudwatch_client.get_metric_data(**metric_params)
+                for metric_result in response["MetricDataResults"]:
+                    volume_id = batch_volumes[int(metric_result["Id"][1:])]
+                    # Datapoint that contains snapshot time is counted whole
+                    volume_since = volumes_since[volume_id] - timedelta(seconds=period)
+                    for timestamp, value in zip(metric_result["Timestamps"], metric_result["Values"]):
+                        last_timestamps[volume_id] = max(timestamp, last_timestamps.get(volume_id, timestamp))
+                        if timestamp >= volume_since:
+                            changed_bytes[volume_id] = (changed_bytes[volume_id] or 0) + int(value)
+                if not response.get("NextToken"):
+                    break
+                metric_params["NextToken"] = response["NextToken"]
+
+            # Without trailing datapoint recent writes are unknown, volume is snapshotted anyway
+            trailing_start = current_date - timedelta(seconds=period) - INGESTION_DELAY
+            for volume_id in batch_volumes:
+                if volume_id not in last_timestamps or last_timestamps[volume_id] < trailing_start:
+                    changed_bytes[volume_id] = None
+
+        return changed_bytes
@@ -0,0 +1,95 @@
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+import threading
+
+GIB = 1024 ** 3
+
+
+class CopyPipeline():
+    """
+    Bounded queue of copy jobs for every target, processed by max_concurrent_copies workers per target.
+    Worker keeps copy in flight until wait_function returns, so per-destination copy limit is never exceeded.
+    copy_pipeline = CopyPipeline(copy_function=copy, wait_function=wait, max_concurrent_copies=5)
+    copy_pipeline.submit('us-west-2', {"snapshot_id": "snap-xxx", "size": 8})
+    copy_results = copy_pipeline.join()
+    copy_function(target, copy_job) returns copy snapshot id, wait_function(target, copy_id) returns final copy state
+    """
+    def __init__(self, copy_function, wait_function, max_concurrent_copies=5, queue_size=100):
+        self.copy_function = copy_function
+        self.wait_function = wait_function
+        self.max_concurrent_copies = max_concurrent_copies
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.workers = []
+        self.results = []
+        self.stats = {}
+
+    def start_target(self, target):
+        self.queues[target] = Queue(maxsize=self.queue_size)
+        self.stats[target] = {"snapshots_in_flight": 0,
+                              "bytes_in_flight": 0,
+                              "peak_snapshots_in_flight": 0,
+                              "peak_bytes_in_flight": 0,
+                              "copied": 0,
+                              "failed": 0,
+                              "bytes_copied": 0}
+        for _ in range(max(1, self.max_concurrent_copies)):
+            worker = threading.Thread(target=self.worker, args=(target,))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, target, copy_job):
+        # Regions submit from own threads, target must be started only once
+        with self.lock:
+            if target not in self.queues:
+                self.start_target(target)
+        # Blocks while target queue is full
+        self.queues[target].put(copy_job)
+
+    def update_stats(self, target, copy_bytes, in_flight_change, copy_state=None):
+        with self.lock:
+            target_stats = self.stats[target]
+            target_stats["snapshots_in_flight"] += in_flight_change
+            target_stats["bytes_in_flight"] += in_flight_change * copy_bytes
+            target_stats["peak_snapshots_in_flight"] = max(target_stats["peak_snapshots_in_flight"], target_stats["snapshots_in_flight"])
+            target_stats["peak_bytes_in_flight"] = max(target_stats["peak_bytes_in_flight"], target_stats["bytes_in_flight"])
+            if copy_state == "completed":
+                target_stats["copied"] += 1
+                target_stats["bytes_copied"] += copy_bytes
+            elif copy_state is not None:
+                target_stats["failed"] += 1
+
+    def worker(self, target):
+        copy_queue = self.queues[target]
+        while True:
+            copy_job = copy_queue.get()
+            if copy_job is None:
+                copy_queue.task_done()
+                return
+
+            copy_result = {"target": target, "job": copy_job, "copy_id": None, "state": "failed", "error": None}
+            copy_bytes = copy_job.get("size", 0) * GIB
+            self.update_stats(target, copy_bytes, 1)
+            try:
+                copy_result["copy_id"] = self.copy_function(target, copy_job)
+                copy_result["state"] = self.wait_function(target, copy_result["copy_id"])
+            except Exception as e:
+                # One failed copy never stops the pipeline
+                copy_result["error"] = e
+            self.update_stats(target, copy_bytes, -1, copy_result["state"])
+
+            with self.lock:
+                self.results.append(copy_result)
+            copy_queue.task_done()
+
+    def join(self):
+        for target, copy_queue in self.queues.items():
+            for _ in range(max(1, self.max_concurrent_copies)):
+                copy_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        return self.results
@@ -1,35 +1,63 @@
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.header import Header
-
-
-class EmailSender():
-    """
-    email_server_config = {"server": "localhost",
-                           "port": 25,
-                           "tls": False}
-    """
-    def __init__(self, email_server_config):
-        self.server_config = email_server_config
-
-    def send_email(self, email_to, email_subject, email_text, email_attach=None):
-        email_message = MIMEMultipart('alternative')
-        email_message['Subject'] = Header(email_subject, 'utf-8')
-        email_message['From'] = self.server_config['from']
-        email_message['To'] = email_to
-        email_message.attach(MIMEText(email_text.encode('utf-8'), 'plain', 'utf-8'))
-
-        try:
-            smtp_connection = smtplib.SMTP(self.server_config["server"], self.server_config["port"], 5)
-
-            if self.server_config["tls"]:
-                smtp_connection.starttls()
-
-            smtp_connection.ehlo()
-            smtp_connection.login(self.server_config["user"], self.server_config["password"])
-            smtp_connection.sendmail(self.server_config['from'], email_to, email_message.as_string())
-            smtp_connection.close()
-        except:
-            return 1
-        return 0
+import smtplib
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.header import Header
+
+
+class EmailSender():
+    """
+    email_server_config = {"server": "localhost",
+                           "port": 25,
+                           "tls": False}
+    email_client.send_emails(email_to_list=['user@localhost'], email_subject='', email_text='')
+    returns {"user@localhost": None} - None on success or error message for every recipient
+    """
+    def __init__(self, email_server_config):
+        self.server_config = email_server_config
+
+    def build_message(self, email_to, email_subject, email_text):
+        email_message = MIMEMultipart('alternative')
+        email_message['Subject'] = Header(email_subject, 'utf-8')
+        email_message['From'] = self.server_config['from']
+        email_message['To'] = email_to
+        email_message.attach(MIMEText(email_text.encode('utf-8'), 'plain', 'utf-8'))
+        return email_message
+
+    def send_emails(self, email_to_list, email_subject, email_text):
+        # One authenticated SMTP session for all recipients
+        email_results = dict((email_to, None) for email_to in email_to_list)
+        if not email_to_list:
+            return email_results
+
+        try:
+            smtp_connection = smtplib.SMTP(self.server_config["server"], self.server_config["port"], timeout=5)
+
+            if self.server_config["tls"]:
+                smtp_connection.starttls()
+
+            smtp_connection.ehlo()
+            smtp_connection.login(self.server_config["user"], self.server_config["password"])
+        except (smtplib.SMTPException, IOError) as e:
+            return dict((email_to, "connection failed: {0}".format(e)) for email_to in email_to_list)
+
+        try:
+            for email_to in email_to_list:
+                email_message = self.build_message(email_to, email_subject, email_text)
+                try:
+                    smtp_connection.sendmail(self.server_config['from'], email_to, email_message.as_string())
+                except smtplib.SMTPRecipientsRefused as e:
+                    email_results[email_to] = "recipient refused: {0}".format(e.recipients.get(email_to, e))
+                except (smtplib.SMTPException, IOError) as e:
+                    email_results[email_to] = str(e)
+        finally:
+            try:
+                smtp_connection.quit()
+            except (smtplib.SMTPException, IOError):
+                smtp_connection.close()
+
+        return email_results
+
+    def send_email(self, email_to, email_subject, email_text, email_attach=None):
+        if self.send_emails([email_to], email_subject, email_text)[email_to]:
+            return 1
+        return 0
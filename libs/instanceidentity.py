@@ -0,0 +1,94 @@
+try:
+    from urllib2 import Request, urlopen, URLError
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import URLError
+from json import dumps, loads
+import socket
+from libs.statefile import read_trusted, write_atomic
+
+METADATA_URL = "http://169.254.169.254/latest"
+BOOT_ID_LOCATION = "/proc/sys/kernel/random/boot_id"
+METADATA_ERRORS = (URLError, socket.error, ValueError)
+
+
+class InstanceIdentity():
+    """
+    Instance identity document from IMDSv2, cached on local disk until instance reboot.
+    Uses urllib from standard library, so requests is not imported for metadata.
+    instance_identity = InstanceIdentity(cache_location='~/.aws-snapshot/aws-snapshot-identity.json', timeout=1)
+    instance_identity.get() - {"instanceId": "i-xxx", "region": "us-east-1", "accountId": "xxx", ...}
+    Raises one of METADATA_ERRORS if metadata is not available, failed request is not repeated.
+    Cache file is created with 0600 mode, file of other user or writable by others is ignored.
+    """
+    def __init__(self, cache_location="", timeout=1, metadata_url=METADATA_URL, boot_id_location=BOOT_ID_LOCATION):
+        self.cache_location = cache_location
+        self.timeout = timeout
+        self.metadata_url = metadata_url
+        self.boot_id_location = boot_id_location
+        self.identity = None
+        self.error = None
+
+    def boot_id(self):
+        try:
+            with open(self.boot_id_location) as boot_id_file:
+                return boot_id_file.read().strip()
+        except IOError:
+            return None
+
+    def load_cache(self, boot_id):
+        if not self.cache_location or boot_id is None:
+            return None
+        # Instance id from cache selects snapshots for deletion, so cache written by somebody else is never used
+        try:
+            identity_cache = loads(read_trusted(self.cache_location) or "{}")
+        except (IOError, ValueError):
+            return None
+        # Identity can't change without reboot
+        if identity_cache.get("boot_id") != boot_id:
+            return None
+        return identity_cache.get("identity")
+
+    def save_cache(self, boot_id, identity):
+        if not self.cache_location or boot_id is None:
+            return
+        try:
+            write_atomic(self.cache_location, dumps({"boot_id": boot_id, "identity": identity}))
+        except (IOError, OSError):
+            pass
+
+    def request(self, url_path, method="GET", headers=None):
+        metadata_request = Request(self.metadata_url + url_path, headers=headers or {})
+        metadata_request.get_method = lambda: method
+        response = urlopen(metadata_request, timeout=self.timeout)
+        try:
+            return response.read().decode("utf-8")
+        finally:
+            response.close()
+
+    def fetch(self):
+        identity_headers = {}
+        try:
+            metadata_token = self.request("/api/token", method="PUT", headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"})
+            identity_headers["X-aws-ec2-metadata-token"] = metadata_token
+        except (URLError, socket.error):
+            # No IMDSv2 or token response dropped by hop limit, for example in docker, fall back to IMDSv1
+            pass
+        return loads(self.request("/dynamic/instance-identity/document", headers=identity_headers))
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+
+        if self.identity is None:
+            boot_id = self.boot_id()
+            self.identity = self.load_cache(boot_id)
+            if self.identity is None:
+                try:
+                    self.identity = self.fetch()
+                except METADATA_ERRORS as e:
+                    self.error = e
+                    raise
+                self.save_cache(boot_id, self.identity)
+
+        return self.identity
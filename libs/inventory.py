@@ -0,0 +1,86 @@
+from datetime import datetime
+from json import load
+from libs.metrics import paginate
+from libs.snapshotindex import SnapshotIndex, SnapshotRecord
+
+START_TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%fZ",
+                      "%Y-%m-%dT%H:%M:%SZ",
+                      "%Y-%m-%dT%H:%M:%S.%f+00:00",
+                      "%Y-%m-%dT%H:%M:%S+00:00")
+
+
+def parse_start_time(start_time, tzinfo=None):
+    if isinstance(start_time, datetime):
+        return start_time
+    # Fast path for ISO 8601 timestamps, strptime is too slow for 100k+ records
+    try:
+        return datetime(int(start_time[0:4]), int(start_time[5:7]), int(start_time[8:10]),
+                        int(start_time[11:13]), int(start_time[14:16]), int(start_time[17:19]), tzinfo=tzinfo)
+    except ValueError:
+        pass
+    for start_time_format in START_TIME_FORMATS:
+        try:
+            return datetime.strptime(start_time, start_time_format).replace(tzinfo=tzinfo)
+        except ValueError:
+            continue
+    raise ValueError("unknown snapshot StartTime format: {0}".format(start_time))
+
+
+def load_inventory_file(inventory_file_path, current_date, expire_days):
+    """
+    Load exported inventory - output of 'aws ec2 describe-snapshots' - without any API calls
+    """
+    with open(inventory_file_path) as inventory_file:
+        inventory_json = load(inventory_file)
+
+    if isinstance(inventory_json, dict):
+        inventory_json = inventory_json["Snapshots"]
+
+    snapshots_index = SnapshotIndex(current_date=current_date, expire_days=expire_days)
+    for snapshot in inventory_json:
+        snapshot["StartTime"] = parse_start_time(snapshot["StartTime"], current_date.tzinfo)
+        snapshots_index.add(SnapshotRecord.from_api(snapshot))
+
+    return snapshots_index
+
+
+class SnapshotInventory():
+    """
+    inventory = SnapshotInventory(ec2_client=ec2.meta.client)
+    snapshots_index = inventory.load(instance_id='i-xxx', volumes=['vol-xxx'], current_date=datetime.now(UTC), expire_days=15)
+    inventory.pages_fetched
+    Copies in other region have VolumeId vol-ffffffff, so volume is taken from tag: load(..., volume_tag='SourceVolumeId')
+    """
+    def __init__(self, ec2_client, page_size=1000):
+        self.ec2_client = ec2_client
+        self.page_size = page_size
+        self.pages_fetched = 0
+
+    def describe_snapshots(self, filters):
+        pages = paginate(self.ec2_client.get_paginator("describe_snapshots"),
+                         OwnerIds=["self"],
+                         Filters=filters,
+                         PaginationConfig={"PageSize": self.page_size})
+        for page in pages:
+            self.pages_fetched += 1
+            for snapshot in page["Snapshots"]:
+                yield snapshot
+
+    def describe_snapshot_ids(self, snapshot_ids):
+        # DescribeSnapshots with SnapshotIds can't be paginated with MaxResults
+        self.pages_fetched += 1
+        response = self.ec2_client.describe_snapshots(SnapshotIds=list(snapshot_ids))
+        return [SnapshotRecord.from_api(snapshot) for snapshot in response["Snapshots"]]
+
+    def load(self, instance_id, volumes, current_date, expire_days, volume_tag=None):
+        snapshots_index = SnapshotIndex(volumes=volumes, current_date=current_date, expire_days=expire_days)
+
+        # One paginated stream for the whole instance, grouped by volume in memory
+        for snapshot in self.describe_snapshots(filters=[{"Name": "tag:InstanceId", "Values": [instance_id]}]):
+            snapshot_record = SnapshotRecord.from_api(snapshot)
+            if volume_tag:
+                snapshot_record.volume = snapshot_record.tags.get(volume_tag, snapshot_record.volume)
+            if snapshot_record.volume in snapshots_index.volumes_records:
+                snapshots_index.add(snapshot_record)
+
+        return snapshots_index
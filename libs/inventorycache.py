@@ -0,0 +1,116 @@
+from json import dumps, loads
+import threading
+import fcntl
+import time
+import os
+from libs.inventory import parse_start_time
+from libs.snapshotindex import SnapshotIndex, SnapshotRecord
+from libs.statefile import open_lock, read_trusted, write_atomic
+
+
+class InventoryCache():
+    """
+    On-disk snapshots inventory, one json line per instance:
+    {"instance_id": "i-xxx", "updated": 1500000000, "volumes": ["vol-xxx"], "snapshots": [["snap-xxx", "vol-xxx", "2017-01-01T00:00:00+00:00", "completed", 8, "standard"]]}
+    inventory_cache = InventoryCache(cache_location='~/.aws-snapshot/aws-snapshot-cache.jsonl', ttl=3600)
+    snapshots_index = inventory_cache.get('i-xxx', volumes=['vol-xxx'], current_date=current_date, expire_days=15)
+    inventory_cache.put('i-xxx', snapshots_index)
+    inventory_cache.save() - entries of other runs saved meanwhile are kept, only entries changed by this run are replaced
+    Cache file is created with 0600 mode, file of other user or writable by others is ignored.
+    """
+    def __init__(self, cache_location, ttl=3600):
+        self.cache_location = cache_location
+        self.ttl = ttl
+        self.entries = {}
+        self.changed_instances = set()
+        self.lock = threading.Lock()
+        self.load()
+
+    def read_entries(self):
+        cache_entries = {}
+        try:
+            # Snapshot ids from cache are deleted, so cache written by somebody else is never used
+            for cache_line in (read_trusted(self.cache_location) or "").splitlines():
+                if cache_line.strip():
+                    cache_entry = loads(cache_line)
+                    cache_entries[cache_entry["instance_id"]] = cache_entry
+        except (IOError, ValueError, KeyError):
+            # Broken cache is the same as empty cache
+            return {}
+        return cache_entries
+
+    def load(self):
+        self.entries = self.read_entries()
+
+    def is_fresh(self, cache_entry):
+        return time.time() - cache_entry["updated"] < self.ttl
+
+    def get(self, instance_id, volumes, current_date, expire_days):
+        with self.lock:
+            cache_entry = self.entries.get(instance_id)
+            if cache_entry is None or not self.is_fresh(cache_entry) or set(cache_entry["volumes"]) != set(volumes):
+                return None
+
+            snapshots_index = SnapshotIndex(volumes=volumes, current_date=current_date, expire_days=expire_days)
+            for cached_snapshot in cache_entry["snapshots"]:
+                snapshot_id, volume, start_time, state, size = cached_snapshot[:5]
+                # Storage tier is not saved by older versions
+                snapshots_index.add(SnapshotRecord(id=snapshot_id,
+                                                   volume=volume,
+                                                   start_time=parse_start_time(start_time, current_date.tzinfo),
+                                                   state=state,
+                                                   size=size,
+                                                   tier=cached_snapshot[5] if len(cached_snapshot) > 5 else "standard"))
+            return snapshots_index
+
+    def put(self, instance_id, snapshots_index):
+        with self.lock:
+            self.changed_instances.add(instance_id)
+            self.entries[instance_id] = {"instance_id": instance_id,
+                                         "updated": time.time(),
+                                         "volumes": snapshots_index.volumes(),
+                                         "snapshots": [self.serialize(record) for record in snapshots_index]}
+
+    def add(self, instance_id, record):
+        with self.lock:
+            if instance_id in self.entries:
+                self.changed_instances.add(instance_id)
+                self.entries[instance_id]["snapshots"].append(self.serialize(record))
+
+    def update(self, instance_id, records):
+        # Replace cached records with refreshed ones, for example pending -> completed
+        with self.lock:
+            if instance_id in self.entries:
+                self.changed_instances.add(instance_id)
+                records = dict((record.id, self.serialize(record)) for record in records)
+                self.entries[instance_id]["snapshots"] = [records.get(snapshot[0], snapshot)
+                                                          for snapshot in self.entries[instance_id]["snapshots"]]
+
+    def remove(self, instance_id, snapshot_ids):
+        with self.lock:
+            if instance_id in self.entries:
+                self.changed_instances.add(instance_id)
+                snapshot_ids = set(snapshot_ids)
+                self.entries[instance_id]["snapshots"] = [snapshot for snapshot in self.entries[instance_id]["snapshots"]
+                                                          if snapshot[0] not in snapshot_ids]
+
+    def save(self):
+        with self.lock:
+            lock_file = open_lock("{0}.lock".format(self.cache_location))
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Overlapping run could save cache after this run loaded it
+                cache_entries = self.read_entries()
+                for instance_id in self.changed_instances:
+                    cache_entries[instance_id] = self.entries[instance_id]
+
+                write_atomic(self.cache_location, "".join(dumps(cache_entry) + "\n"
+                                                          for cache_entry in cache_entries.values() if self.is_fresh(cache_entry)))
+                self.entries = cache_entries
+                self.changed_instances = set()
+            finally:
+                os.close(lock_file)
+
+    @staticmethod
+    def serialize(record):
+        return [record.id, record.volume, record.start_time.isoformat(), record.state, record.size, record.tier]
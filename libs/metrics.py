@@ -0,0 +1,179 @@
+from contextlib import contextmanager
+from json import dump
+from os import rename
+import threading
+import time
+from libs.throttle import THROTTLE_ERROR_CODES
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Set while paginator fetches page in current thread, so calls made between pages are not counted as pages
+paginator_state = threading.local()
+
+
+def paginate(paginator, **kwargs):
+    """
+    Pages of paginator.paginate(**kwargs), counted as pages by every MetricsCollector.
+    botocore sends MaxResults only with PageSize, so pages can't be told from other calls by request params.
+    for page in paginate(ec2_client.get_paginator('describe_volumes'), Filters=filters):
+    """
+    pages = iter(paginator.paginate(**kwargs))
+    while True:
+        paginator_state.active = True
+        try:
+            page = next(pages)
+        except StopIteration:
+            return
+        finally:
+            paginator_state.active = False
+        yield page
+
+
+class MetricsCollector():
+    """
+    Per-operation AWS API metrics from botocore events and run phases timings.
+    run_metrics = MetricsCollector(labels={"region": "us-east-1"})
+    run_metrics.register(ec2_client)
+    with run_metrics.phase("inventory"):
+        ...
+    run_metrics.write('/var/lib/node_exporter/aws-snapshot.prom', metrics_format='prometheus')
+    """
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.phases = {}
+        self.started = time.time()
+
+    def register(self, client):
+        client.meta.events.register("before-call", self.before_call)
+        client.meta.events.register("after-call", self.after_call)
+
+    def operation_metrics(self, operation_name):
+        if operation_name not in self.operations:
+            self.operations[operation_name] = {"calls": 0,
+                                               "pages": 0,
+                                               "retries": 0,
+                                               "throttles": 0,
+                                               "errors": 0,
+                                               "latency_sum": 0.0,
+                                               "latency_buckets": [0] * len(LATENCY_BUCKETS)}
+        return self.operations[operation_name]
+
+    def before_call(self, model=None, params=None, context=None, **kwargs):
+        if context is not None:
+            context["metrics_call_start"] = time.time()
+            context["metrics_paginated"] = getattr(paginator_state, "active", False)
+
+    def after_call(self, model=None, parsed=None, context=None, **kwargs):
+        call_start = (context or {}).get("metrics_call_start")
+        if model is None or call_start is None:
+            return
+        call_latency = time.time() - call_start
+        parsed = parsed or {}
+        error_code = parsed.get("Error", {}).get("Code")
+
+        with self.lock:
+            operation = self.operation_metrics(model.name)
+            operation["calls"] += 1
+            if context.get("metrics_paginated"):
+                operation["pages"] += 1
+            operation["retries"] += parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+            if error_code:
+                operation["errors"] += 1
+            if error_code in THROTTLE_ERROR_CODES:
+                operation["throttles"] += 1
+            operation["latency_sum"] += call_latency
+            for bucket_position, bucket_limit in enumerate(LATENCY_BUCKETS):
+                if call_latency <= bucket_limit:
+                    operation["latency_buckets"][bucket_position] += 1
+
+    def add_phase(self, phase_name, phase_duration):
+        with self.lock:
+            phase = self.phases.setdefault(phase_name, {"seconds": 0.0, "runs": 0})
+            phase["seconds"] += phase_duration
+            phase["runs"] += 1
+
+    @contextmanager
+    def phase(self, phase_name):
+        phase_start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(phase_name, time.time() - phase_start)
+
+    def as_dict(self):
+        with self.lock:
+            return {"labels": self.labels,
+                    "timestamp": time.time(),
+                    "duration": time.time() - self.started,
+                    "operations": dict((operation_name, dict(operation, latency_buckets=list(operation["latency_buckets"])))
+                                       for operation_name, operation in self.operations.items()),
+                    "phases": dict((phase_name, dict(phase)) for phase_name, phase in self.phases.items())}
+
+    def format_labels(self, **labels):
+        labels_dict = dict(self.labels, **labels)
+        if not labels_dict:
+            return ""
+        return "{" + ",".join('{0}="{1}"'.format(label, labels_dict[label]) for label in sorted(labels_dict)) + "}"
+
+    def as_prometheus(self):
+        metrics_dict = self.as_dict()
+        metrics_lines = []
+        counters = (("calls", "aws_snapshot_api_calls_total", "AWS API calls"),
+                    ("pages", "aws_snapshot_api_pages_total", "AWS API describe pages"),
+                    ("retries", "aws_snapshot_api_retries_total", "AWS API retries made by botocore"),
+                    ("throttles", "aws_snapshot_api_throttles_total", "AWS API calls failed with throttling"),
+                    ("errors", "aws_snapshot_api_errors_total", "AWS API calls failed with error"))
+
+        for counter_key, metric_name, metric_help in counters:
+            metrics_lines.append("# HELP {0} {1}".format(metric_name, metric_help))
+            metrics_lines.append("# TYPE {0} counter".format(metric_name))
+            for operation_name in sorted(metrics_dict["operations"]):
+                metrics_lines.append("{0}{1} {2}".format(metric_name,
+                                                         self.format_labels(operation=operation_name),
+                                                         metrics_dict["operations"][operation_name][counter_key]))
+
+        metrics_lines.append("# HELP aws_snapshot_api_latency_seconds AWS API call latency")
+        metrics_lines.append("# TYPE aws_snapshot_api_latency_seconds histogram")
+        for operation_name in sorted(metrics_dict["operations"]):
+            operation = metrics_dict["operations"][operation_name]
+            for bucket_limit, bucket_count in zip(LATENCY_BUCKETS, operation["latency_buckets"]):
+                metrics_lines.append("aws_snapshot_api_latency_seconds_bucket{0} {1}".format(
+                    self.format_labels(operation=operation_name, le=bucket_limit), bucket_count))
+            metrics_lines.append("aws_snapshot_api_latency_seconds_bucket{0} {1}".format(
+                self.format_labels(operation=operation_name, le="+Inf"), operation["calls"]))
+            metrics_lines.append("aws_snapshot_api_latency_seconds_sum{0} {1:.6f}".format(
+                self.format_labels(operation=operation_name), operation["latency_sum"]))
+            metrics_lines.append("aws_snapshot_api_latency_seconds_count{0} {1}".format(
+                self.format_labels(operation=operation_name), operation["calls"]))
+
+        metrics_lines.append("# HELP aws_snapshot_phase_seconds Time spent in run phase")
+        metrics_lines.append("# TYPE aws_snapshot_phase_seconds gauge")
+        for phase_name in sorted(metrics_dict["phases"]):
+            metrics_lines.append("aws_snapshot_phase_seconds{0} {1:.6f}".format(
+                self.format_labels(phase=phase_name), metrics_dict["phases"][phase_name]["seconds"]))
+        metrics_lines.append("# HELP aws_snapshot_phase_runs Number of times run phase was executed")
+        metrics_lines.append("# TYPE aws_snapshot_phase_runs gauge")
+        for phase_name in sorted(metrics_dict["phases"]):
+            metrics_lines.append("aws_snapshot_phase_runs{0} {1}".format(
+                self.format_labels(phase=phase_name), metrics_dict["phases"][phase_name]["runs"]))
+
+        metrics_lines.append("# HELP aws_snapshot_last_run_timestamp_seconds Time of last run")
+        metrics_lines.append("# TYPE aws_snapshot_last_run_timestamp_seconds gauge")
+        metrics_lines.append("aws_snapshot_last_run_timestamp_seconds{0} {1:.0f}".format(self.format_labels(),
+                                                                                        metrics_dict["timestamp"]))
+        metrics_lines.append("# HELP aws_snapshot_run_duration_seconds Duration of last run")
+        metrics_lines.append("# TYPE aws_snapshot_run_duration_seconds gauge")
+        metrics_lines.append("aws_snapshot_run_duration_seconds{0} {1:.6f}".format(self.format_labels(),
+                                                                                  metrics_dict["duration"]))
+        return "\n".join(metrics_lines) + "\n"
+
+    def write(self, metrics_location, metrics_format="prometheus"):
+        # Write to temporary file and rename, so textfile collector never reads half written file
+        metrics_location_tmp = "{0}.tmp".format(metrics_location)
+        with open(metrics_location_tmp, "w") as metrics_file:
+            if metrics_format == "json":
+                dump(self.as_dict(), metrics_file, indent=2, sort_keys=True)
+            else:
+                metrics_file.write(self.as_prometheus())
+        rename(metrics_location_tmp, metrics_location)
@@ -0,0 +1,108 @@
+from contextlib import contextmanager
+from json import dumps, loads
+import fcntl
+import time
+import os
+from libs.statefile import open_lock, read_trusted, write_atomic
+
+MAX_RETRY_INTERVAL = 86400
+
+
+class NotifySpool():
+    """
+    Local spool of run results for digest notifications, json file shared by all runs on host and guarded by file lock:
+    {"runs": [{"time": 1500000000, "instance_id": "i-xxx", ...}], "outbox": [{"channel": "slack", "recipients": ["#backup"], ...}]}
+    notify_spool = NotifySpool(spool_location='~/.aws-snapshot/aws-snapshot-notify.json', window=86400)
+    notify_spool.add([{"time": time.time(), "instance_id": "i-xxx", ...}])
+    notify_spool.flush(build_messages=build, send_message=send)
+    build_messages(window_start, runs) returns messages of closed window, send_message(message) returns failed recipients.
+    Failed messages stay in outbox and are retried by next flush, so sending never waits for rate limits.
+    Spool file is created with 0600 mode, file of other user or writable by others is ignored, raises OSError for such lock file.
+    """
+    def __init__(self, spool_location, window=86400, retry_interval=300, max_attempts=10):
+        self.spool_location = spool_location
+        self.window = window
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+
+    def window_start(self, run_time):
+        return int(run_time // self.window * self.window)
+
+    @contextmanager
+    def locked(self, blocking=True):
+        lock_descriptor = open_lock("{0}.lock".format(self.spool_location))
+        try:
+            try:
+                fcntl.flock(lock_descriptor, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Other run is flushing spool right now
+                yield None
+                return
+
+            spool_data = {"runs": [], "outbox": []}
+            try:
+                # Outbox is sent with service credentials, so spool written by somebody else is never used
+                spool_data.update(loads(read_trusted(self.spool_location) or "{}"))
+            except ValueError:
+                # Broken spool is the same as empty spool
+                pass
+
+            yield spool_data
+
+            write_atomic(self.spool_location, dumps(spool_data))
+        finally:
+            os.close(lock_descriptor)
+
+    def add(self, runs):
+        with self.locked() as spool_data:
+            spool_data["runs"] += runs
+
+    def collect(self, spool_data, build_messages, current_time):
+        # Runs of closed windows become digest messages, runs of current window wait
+        closed_windows = {}
+        open_runs = []
+        for run in spool_data["runs"]:
+            run_window_start = self.window_start(run["time"])
+            if run_window_start + self.window <= current_time:
+                closed_windows.setdefault(run_window_start, []).append(run)
+            else:
+                open_runs.append(run)
+
+        for window_start, window_runs in sorted(closed_windows.items()):
+            for message in build_messages(window_start, window_runs):
+                message.update({"window": window_start, "attempts": 0, "next_attempt": current_time})
+                spool_data["outbox"].append(message)
+        spool_data["runs"] = open_runs
+
+    def flush(self, build_messages, send_message, current_time=None):
+        current_time = current_time or time.time()
+        flush_result = {"sent": 0, "retry": 0, "dropped": [], "busy": False}
+
+        with self.locked(blocking=False) as spool_data:
+            if spool_data is None:
+                flush_result["busy"] = True
+                return flush_result
+
+            self.collect(spool_data, build_messages, current_time)
+
+            outbox = []
+            for message in spool_data["outbox"]:
+                if message["next_attempt"] > current_time:
+                    outbox.append(message)
+                    continue
+
+                message["attempts"] += 1
+                failed_recipients = send_message(message)
+                if not failed_recipients:
+                    flush_result["sent"] += 1
+                elif message["attempts"] >= self.max_attempts:
+                    flush_result["dropped"].append(message)
+                else:
+                    # Only recipients that failed get message again
+                    message["recipients"] = failed_recipients
+                    message["next_attempt"] = current_time + min(self.retry_interval * 2 ** (message["attempts"] - 1), MAX_RETRY_INTERVAL)
+                    flush_result["retry"] += 1
+                    outbox.append(message)
+            spool_data["outbox"] = outbox
+
+        return flush_result
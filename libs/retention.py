@@ -0,0 +1,59 @@
+RETENTION_PERIODS = (("hourly", lambda start_time: start_time.strftime("%Y-%m-%d %H")),
+                     ("daily", lambda start_time: start_time.date()),
+                     ("weekly", lambda start_time: start_time.isocalendar()[:2]),
+                     ("monthly", lambda start_time: (start_time.year, start_time.month)))
+
+
+class RetentionPolicy():
+    """
+    Grandfather-father-son retention for snapshots of one volume:
+    - min_count newest snapshots are always kept
+    - snapshots not older than max_age_days are kept
+    - older snapshots are kept only as newest snapshot of one of N last hours\\days\\weeks\\months
+    retention_policy = RetentionPolicy(daily=7, weekly=4, monthly=12, min_count=1, max_age_days=15)
+    """
+    def __init__(self, hourly=0, daily=0, weekly=0, monthly=0, min_count=1, max_age_days=None):
+        self.periods = {"hourly": hourly,
+                        "daily": daily,
+                        "weekly": weekly,
+                        "monthly": monthly}
+        self.min_count = min_count
+        self.max_age_days = max_age_days
+
+    def is_expired(self, start_time, current_date):
+        if self.max_age_days is None:
+            return False
+        return (current_date - start_time).days + 1 > self.max_age_days
+
+
+def plan_retention(snapshots, retention_policy, current_date):
+    """
+    Pure keep\\delete plan for snapshots of one volume, no API calls.
+    snapshots - iterable of records with id and start_time
+    returns {"keep": [(snapshot, reason), ...], "delete": [snapshot, ...]}, both newest first
+    """
+    retention_plan = {"keep": [], "delete": []}
+    periods_seen = dict((period_name, set()) for period_name, _ in RETENTION_PERIODS)
+
+    for position, snapshot in enumerate(sorted(snapshots, key=lambda record: record.start_time, reverse=True)):
+        keep_reasons = []
+        for period_name, period_key in RETENTION_PERIODS:
+            period_limit = retention_policy.periods[period_name]
+            if not period_limit or len(periods_seen[period_name]) >= period_limit:
+                continue
+            snapshot_period = period_key(snapshot.start_time)
+            if snapshot_period not in periods_seen[period_name]:
+                periods_seen[period_name].add(snapshot_period)
+                keep_reasons.append(period_name)
+
+        if position < retention_policy.min_count:
+            keep_reasons.append("min_count")
+        if not retention_policy.is_expired(snapshot.start_time, current_date):
+            keep_reasons.append("max_age")
+
+        if keep_reasons:
+            retention_plan["keep"].append((snapshot, ",".join(keep_reasons)))
+        else:
+            retention_plan["delete"].append(snapshot)
+
+    return retention_plan
@@ -0,0 +1,99 @@
+from socket import gethostname
+from os import getpid, path
+import fcntl
+import time
+import os
+from libs.statefile import open_lock
+
+LOCK_TAG = "aws-snapshot:lock"
+
+
+def lock_owner():
+    return "{0}:{1}".format(gethostname(), getpid())
+
+
+class FileLock():
+    """
+    Local lock file for one resource, held until release() or until process exits.
+    file_lock = FileLock(lock_directory='~/.aws-snapshot', resource_id='i-xxx')
+    file_lock.acquire() - False if other run holds lock, file_lock.holder is its owner then
+    file_lock.release()
+    Lock file is created with 0600 mode, raises OSError for symlink or lock file of other user.
+    """
+    def __init__(self, lock_directory, resource_id, owner=None):
+        self.lock_location = path.join(lock_directory, "aws-snapshot-{0}.lock".format(resource_id))
+        self.owner = owner or lock_owner()
+        self.holder = None
+        self.lock_descriptor = None
+
+    def acquire(self):
+        lock_descriptor = open_lock(self.lock_location)
+        try:
+            fcntl.flock(lock_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.holder = os.read(lock_descriptor, 1024).decode("utf-8").strip() or None
+            os.close(lock_descriptor)
+            return False
+
+        os.ftruncate(lock_descriptor, 0)
+        os.write(lock_descriptor, self.owner.encode("utf-8"))
+        self.lock_descriptor = lock_descriptor
+        self.holder = self.owner
+        return True
+
+    def release(self):
+        if self.lock_descriptor is not None:
+            fcntl.flock(self.lock_descriptor, fcntl.LOCK_UN)
+            os.close(self.lock_descriptor)
+            self.lock_descriptor = None
+
+
+class TagLease():
+    """
+    Lease stored in EC2 resource tag, so runs on different hosts see each other.
+    Lease expires after ttl seconds, so crashed run never blocks resource forever.
+    tag_lease = TagLease(ec2_client=ec2, resource_id='i-xxx', ttl=7200)
+    tag_lease.acquire() - False if other run holds not expired lease, tag_lease.holder is its owner then
+    tag_lease.release() - lease tag is deleted only if it still has our value
+    Tags have no conditional write, so lease is read again after write and last writer wins.
+    """
+    def __init__(self, ec2_client, resource_id, ttl=7200, owner=None, tag_key=LOCK_TAG):
+        self.ec2_client = ec2_client
+        self.resource_id = resource_id
+        self.ttl = ttl
+        self.owner = owner or lock_owner()
+        self.tag_key = tag_key
+        self.holder = None
+        self.lease_value = None
+
+    def current_holder(self):
+        response = self.ec2_client.describe_tags(Filters=[{"Name": "resource-id", "Values": [self.resource_id]},
+                                                          {"Name": "key", "Values": [self.tag_key]}])
+        for resource_tag in response["Tags"]:
+            lease_owner, _, lease_expires = resource_tag["Value"].rpartition(" ")
+            try:
+                if float(lease_expires) > time.time():
+                    return lease_owner
+            except ValueError:
+                # Broken lease value is treated as expired
+                pass
+        return None
+
+    def acquire(self):
+        self.holder = self.current_holder()
+        if self.holder is not None and self.holder != self.owner:
+            return False
+
+        lease_value = "{0} {1}".format(self.owner, int(time.time() + self.ttl))
+        self.ec2_client.create_tags(Resources=[self.resource_id], Tags=[{"Key": self.tag_key, "Value": lease_value}])
+
+        self.holder = self.current_holder()
+        if self.holder != self.owner:
+            return False
+        self.lease_value = lease_value
+        return True
+
+    def release(self):
+        if self.lease_value is not None:
+            self.ec2_client.delete_tags(Resources=[self.resource_id], Tags=[{"Key": self.tag_key, "Value": self.lease_value}])
+            self.lease_value = None
@@ -1,21 +1,40 @@
-from urllib import urlencode
-import urllib2 as urlrequest
-import json
-
-
-class SlackSender():
-    def __init__(self, api_url=""):
-        self.api_url = api_url
-        self.url_opener = urlrequest.build_opener(urlrequest.HTTPHandler())
-
-    def send_message(self, **kwargs):
-        payload = kwargs
-        payload_json = json.dumps(payload)
-        data = urlencode({"payload": payload_json})
-        req = urlrequest.Request(self.api_url)
-        try:
-            response = self.url_opener.open(req, data.encode('utf-8')).read()
-        except:
-            print "failed connect to slack hook"
-            return 1
-        return response.decode('utf-8')
+from requests.adapters import HTTPAdapter
+import requests
+import json
+from libs.throttle import concurrent_map
+
+
+class SlackSender():
+    """
+    slack_client = SlackSender(api_url='https://hooks.slack.com/services/xxx', concurrency=8)
+    slack_client.send_messages(channels=['#backup', '@user'], username='bot', attachments=[])
+    returns {"#backup": None, "@user": None} - None on success or error message for every channel
+    """
+    def __init__(self, api_url="", concurrency=8):
+        self.api_url = api_url
+        self.concurrency = concurrency
+        # Keep-alive connections shared by all workers
+        self.http_session = requests.Session()
+        self.http_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+        self.http_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+
+    def post_message(self, **kwargs):
+        payload_json = json.dumps(kwargs)
+        response = self.http_session.post(self.api_url, data={"payload": payload_json}, timeout=10)
+        response.raise_for_status()
+        return response.text
+
+    def send_message(self, **kwargs):
+        try:
+            return self.post_message(**kwargs)
+        except requests.exceptions.RequestException:
+            print ("failed connect to slack hook")
+            return 1
+
+    def send_messages(self, channels, **kwargs):
+        def send_channel_message(channel):
+            return self.post_message(channel=channel, **kwargs)
+
+        send_operations = concurrent_map(send_channel_message, channels, self.concurrency)
+        return dict((send_operation["item"], str(send_operation["error"]) if send_operation["error"] else None)
+                    for send_operation in send_operations)
@@ -0,0 +1,112 @@
+class SnapshotRecord(object):
+    __slots__ = ("id", "volume", "start_time", "tags", "state", "size", "tier")
+
+    def __init__(self, id, volume, start_time, tags=None, state="completed", size=0, tier="standard"):
+        self.id = id
+        self.volume = volume
+        self.start_time = start_time
+        self.tags = tags or {}
+        self.state = state
+        self.size = size
+        self.tier = tier
+
+    @classmethod
+    def from_api(cls, snapshot):
+        return cls(id=snapshot["SnapshotId"],
+                   volume=snapshot["VolumeId"],
+                   start_time=snapshot["StartTime"],
+                   tags=dict((tag["Key"], tag["Value"]) for tag in snapshot.get("Tags", [])),
+                   state=snapshot.get("State", "completed"),
+                   size=snapshot.get("VolumeSize", 0),
+                   tier=snapshot.get("StorageTier", "standard"))
+
+    def __repr__(self):
+        return "SnapshotRecord({0}:{1})".format(self.volume, self.id)
+
+
+class SnapshotIndex(object):
+    """
+    snapshots_index = SnapshotIndex(volumes=['vol-xxx'], current_date=datetime.now(UTC), expire_days=15)
+    snapshots_index.add(SnapshotRecord.from_api(snapshot))
+    snapshots_index.volume_snapshots('vol-xxx')[save_count:] - all snapshots except N newest
+    snapshots_index.remove('snap-xxx')
+    """
+    def __init__(self, volumes=(), current_date=None, expire_days=None):
+        self.current_date = current_date
+        self.expire_days = expire_days
+        self.records = {}
+        self.expired_ids = set()
+        self.volumes_records = {}
+        self.volumes_sorted = {}
+        for volume in volumes:
+            self.add_volume(volume)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, snapshot_id):
+        return snapshot_id in self.records
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def get(self, snapshot_id):
+        return self.records.get(snapshot_id)
+
+    def add_volume(self, volume):
+        if volume not in self.volumes_records:
+            self.volumes_records[volume] = {}
+            self.volumes_sorted[volume] = []
+
+    def is_expired(self, record):
+        if self.current_date is None or self.expire_days is None:
+            return False
+        return (self.current_date - record.start_time).days + 1 > self.expire_days
+
+    def add(self, record):
+        self.add_volume(record.volume)
+        self.records[record.id] = record
+        self.volumes_records[record.volume][record.id] = record
+        self.volumes_sorted[record.volume] = None
+        if self.is_expired(record):
+            self.expired_ids.add(record.id)
+
+    def remove(self, snapshot_id):
+        record = self.records.pop(snapshot_id, None)
+        if record is not None:
+            del self.volumes_records[record.volume][snapshot_id]
+            self.volumes_sorted[record.volume] = None
+            self.expired_ids.discard(snapshot_id)
+        return record
+
+    def update(self, snapshots_index):
+        for volume in snapshots_index.volumes():
+            self.add_volume(volume)
+        for record in snapshots_index:
+            self.add(record)
+            if record.id in snapshots_index.expired_ids:
+                self.expired_ids.add(record.id)
+
+    def volumes(self):
+        return list(self.volumes_records)
+
+    def volume_count(self, volume):
+        return len(self.volumes_records.get(volume, ()))
+
+    def volume_snapshots(self, volume):
+        # Newest first, sorted lazily after changes
+        if volume not in self.volumes_records:
+            return []
+        if self.volumes_sorted[volume] is None:
+            self.volumes_sorted[volume] = sorted(self.volumes_records[volume].values(),
+                                                 key=lambda record: record.start_time,
+                                                 reverse=True)
+        return self.volumes_sorted[volume]
+
+    def expired(self, volume=None):
+        if volume is None:
+            return [self.records[snapshot_id] for snapshot_id in self.expired_ids]
+        return [record for record in self.volume_snapshots(volume) if record.id in self.expired_ids]
+
+    def expired_count(self):
+        return len(self.expired_ids)
@@ -0,0 +1,50 @@
+from json import dumps
+import threading
+import csv
+import sys
+
+OUTPUT_FORMATS = ("json", "csv", "ndjson")
+OUTPUT_FIELDS = ("id", "volume", "instance", "region", "start_time", "age_days", "size", "state", "action", "reason")
+
+
+class SnapshotWriter():
+    """
+    Stream snapshot records as json array, csv or ndjson - every record is written right away and not kept in memory.
+    Safe to use from many workers, records of different instances are not mixed inside one line.
+    snapshot_writer = SnapshotWriter(output_location='-', output_format='csv')
+    snapshot_writer.write({"id": "snap-xxx", "volume": "vol-xxx", ...})
+    snapshot_writer.close()
+    """
+    def __init__(self, output_location="-", output_format="ndjson"):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("unknown output format: {0}".format(output_format))
+        self.output_location = output_location
+        self.output_format = output_format
+        self.output_file = sys.stdout if output_location == "-" else open(output_location, "w")
+        self.lock = threading.Lock()
+        self.records_count = 0
+        self.csv_writer = None
+
+        if output_format == "csv":
+            self.csv_writer = csv.DictWriter(self.output_file, fieldnames=OUTPUT_FIELDS, lineterminator="\n")
+            self.csv_writer.writeheader()
+        elif output_format == "json":
+            self.output_file.write("[")
+
+    def write(self, record):
+        with self.lock:
+            if self.output_format == "csv":
+                self.csv_writer.writerow(record)
+            elif self.output_format == "json":
+                self.output_file.write("{0}\n{1}".format("," if self.records_count else "", dumps(record, sort_keys=True)))
+            else:
+                self.output_file.write(dumps(record, sort_keys=True) + "\n")
+            self.records_count += 1
+
+    def close(self):
+        with self.lock:
+            if self.output_format == "json":
+                self.output_file.write("\n]\n")
+            self.output_file.flush()
+            if self.output_file is not sys.stdout:
+                self.output_file.close()
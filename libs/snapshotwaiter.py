@@ -0,0 +1,61 @@
+import calendar
+import time
+
+
+class SnapshotWaiter():
+    """
+    Poll many snapshots at once - one DescribeSnapshots call per tick for every batch_size snapshots.
+    Poll interval grows while nothing changes and resets when some snapshot finishes.
+    snapshot_waiter = SnapshotWaiter(describe_snapshots=inventory.describe_snapshot_ids, interval=5, timeout=3600)
+    snapshot_waiter.wait(['snap-xxx'])
+    returns {"snap-xxx": {"state": "completed", "duration": 120.5}} - duration is None for not finished snapshots
+    Duration is counted from snapshot start_time, not from start of waiting, which can begin much later in fleet mode.
+    on_finished(snapshot_id, wait_result) is called as soon as snapshot is finished, before other snapshots are done
+    """
+    def __init__(self, describe_snapshots, interval=5, max_interval=60, timeout=3600, batch_size=500, sleep=time.sleep, clock=time.time):
+        self.describe_snapshots = describe_snapshots
+        self.interval = interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.sleep = sleep
+        self.clock = clock
+        self.polls_count = 0
+
+    @staticmethod
+    def started(snapshot, wait_start):
+        if snapshot.start_time is None:
+            return wait_start
+        return calendar.timegm(snapshot.start_time.utctimetuple()) + snapshot.start_time.microsecond / 1000000.0
+
+    def wait(self, snapshot_ids, on_finished=None):
+        wait_start = self.clock()
+        wait_results = dict((snapshot_id, {"state": "pending", "duration": None}) for snapshot_id in snapshot_ids)
+        pending_snapshot_ids = set(snapshot_ids)
+        poll_interval = self.interval
+
+        while pending_snapshot_ids:
+            wait_elapsed = self.clock() - wait_start
+            if wait_elapsed >= self.timeout:
+                break
+            self.sleep(min(poll_interval, self.timeout - wait_elapsed))
+            self.polls_count += 1
+
+            finished_count = 0
+            pending_snapshot_list = sorted(pending_snapshot_ids)
+            for batch_start in range(0, len(pending_snapshot_list), self.batch_size):
+                for snapshot in self.describe_snapshots(pending_snapshot_list[batch_start:batch_start + self.batch_size]):
+                    wait_results[snapshot.id]["state"] = snapshot.state
+                    if snapshot.state != "pending":
+                        wait_results[snapshot.id]["duration"] = round(self.clock() - self.started(snapshot, wait_start), 1)
+                        pending_snapshot_ids.discard(snapshot.id)
+                        finished_count += 1
+                        if on_finished is not None:
+                            on_finished(snapshot.id, wait_results[snapshot.id])
+
+            if finished_count:
+                poll_interval = self.interval
+            else:
+                poll_interval = min(self.max_interval, poll_interval * 1.5)
+
+        return wait_results
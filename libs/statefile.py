@@ -0,0 +1,59 @@
+from os import path
+import tempfile
+import errno
+import stat
+import os
+
+STATE_LOCATION = "~/.aws-snapshot"
+
+
+def is_owned(file_stat):
+    return file_stat.st_uid == os.getuid() and not file_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def is_trusted(file_stat):
+    return stat.S_ISREG(file_stat.st_mode) and is_owned(file_stat)
+
+
+def read_trusted(file_location):
+    # Missing, planted or foreign file reads as no state, O_NONBLOCK keeps planted fifo from hanging run
+    try:
+        file_descriptor = os.open(file_location, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except OSError:
+        return None
+    with os.fdopen(file_descriptor) as state_file:
+        if not is_trusted(os.fstat(file_descriptor)):
+            return None
+        return state_file.read()
+
+
+def open_lock(lock_location):
+    # Symlink is never followed and lock file created by other user is refused, so it can't block runs
+    lock_descriptor = os.open(lock_location, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_NONBLOCK, 0o600)
+    if not is_trusted(os.fstat(lock_descriptor)):
+        os.close(lock_descriptor)
+        raise OSError(errno.EPERM, "lock file is owned or writable by other user", lock_location)
+    return lock_descriptor
+
+
+def write_atomic(file_location, file_content):
+    # mkstemp creates new 0600 file, so planted symlink or file is never written through
+    file_descriptor, file_location_tmp = tempfile.mkstemp(dir=path.dirname(file_location) or ".",
+                                                          prefix=path.basename(file_location))
+    try:
+        with os.fdopen(file_descriptor, "w") as state_file:
+            state_file.write(file_content)
+        os.rename(file_location_tmp, file_location)
+    except (IOError, OSError):
+        if path.exists(file_location_tmp):
+            os.remove(file_location_tmp)
+        raise
+
+
+def make_state_directory(state_location):
+    if not path.isdir(state_location):
+        os.makedirs(state_location, 0o700)
+    state_stat = os.lstat(state_location)
+    if not stat.S_ISDIR(state_stat.st_mode) or not is_owned(state_stat):
+        raise OSError(errno.EPERM, "state directory is owned or writable by other user", state_location)
+    return state_location
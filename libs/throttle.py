@@ -0,0 +1,123 @@
+import threading
+import random
+import time
+
+THROTTLE_ERROR_CODES = ("RequestLimitExceeded",
+                        "SnapshotCreationPerVolumeRateExceeded",
+                        "Throttling",
+                        "ThrottlingException")
+
+
+def concurrent_map(function, items, concurrency=1):
+    """
+    Run function for every item on up to concurrency threads and collect every operation result:
+    [{"item": item, "result": function(item), "error": None}, ...]
+    Plain threads are used instead of ThreadPool, its close\\join waits ~100ms on python 2.7 for every call.
+    """
+    def operation(item):
+        operation_result = {"item": item, "result": None, "error": None}
+        try:
+            operation_result["result"] = function(item)
+        except Exception as e:
+            operation_result["error"] = e
+        return operation_result
+
+    items = list(items)
+    workers_count = max(1, min(concurrency, len(items)))
+    if workers_count == 1:
+        return [operation(item) for item in items]
+
+    operation_results = [None] * len(items)
+    positions = iter(range(len(items)))
+    positions_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with positions_lock:
+                position = next(positions, None)
+            if position is None:
+                return
+            operation_results[position] = operation(items[position])
+
+    workers = [threading.Thread(target=worker) for _ in range(workers_count)]
+    for operation_worker in workers:
+        operation_worker.daemon = True
+        operation_worker.start()
+    for operation_worker in workers:
+        operation_worker.join()
+    return operation_results
+
+
+class AdaptiveThrottle():
+    """
+    Token bucket shared by all workers. Rate grows additively on success and halves on throttling errors (AIMD).
+    Throttle is driven by botocore events of registered clients, so every request, page and retry takes token
+    and retries are decided here - client should be created with botocore retries disabled.
+    api_throttle = AdaptiveThrottle(rate=10, max_retries=5)
+    api_throttle.register(ec2_client)
+    ec2_client.delete_snapshot(SnapshotId='snap-xxx')
+    """
+    def __init__(self, rate=10.0, min_rate=0.5, max_rate=None, rate_step=0.1, max_retries=5, backoff_base=0.5, backoff_max=20.0):
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate or rate * 4)
+        self.rate_step = rate_step
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.tokens = 1.0
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+        self.calls_count = 0
+        self.throttled_count = 0
+
+    def register(self, client):
+        client.meta.events.register("before-send", self.before_send)
+        client.meta.events.register("needs-retry", self.needs_retry)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                current_time = time.time()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (current_time - self.last_refill) * self.rate)
+                self.last_refill = current_time
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait_time = (1.0 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def on_success(self):
+        with self.lock:
+            self.calls_count += 1
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+    def on_throttle(self):
+        with self.lock:
+            self.calls_count += 1
+            self.throttled_count += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def before_send(self, **kwargs):
+        # Returned None lets botocore send request
+        self.acquire()
+
+    def needs_retry(self, response=None, attempts=1, caught_exception=None, **kwargs):
+        # botocore sleeps returned seconds and sends request again, None means no retry
+        if caught_exception is not None:
+            # Connection errors and timeouts
+            retry = True
+        else:
+            http_response, parsed = response
+            if (parsed or {}).get("Error", {}).get("Code") in THROTTLE_ERROR_CODES:
+                self.on_throttle()
+                retry = True
+            else:
+                self.on_success()
+                retry = http_response.status_code >= 500
+
+        if not retry or attempts > self.max_retries:
+            return None
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1)))
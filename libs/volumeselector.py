@@ -0,0 +1,70 @@
+FILTER_NAMES = {"type": "volume-type",
+                "device": "attachment.device"}
+FILTER_BATCH_SIZE = 200
+
+
+def parse_size_range(size_expression):
+    # "100-500", "100-" or "-500" GiB, both ends included
+    size_min, _, size_max = size_expression.partition("-")
+    return (int(size_min) if size_min.strip() else None,
+            int(size_max) if size_max.strip() else None)
+
+
+class VolumeSelector():
+    """
+    Volumes selection from snapshot_volumes list, resolved by DescribeVolumes filters.
+    Every item narrows selection of attached volumes: volume id or expression name=value1,value2:
+    tag:Backup=true, type=gp3,io2, size=100 or size=100-500, device=/dev/xvdf or /dev/sd*, root=false
+    and any other DescribeVolumes filter name, for example encrypted=true. "all" or empty list selects all volumes.
+    volume_selector = VolumeSelector(['tag:Backup=true', 'size=10-500', 'root=false'])
+    volume_selector.filters(['i-xxx']) - DescribeVolumes filters
+    volume_selector.match(volume, attachment, root_device_name='/dev/xvda') - checks that can't be done by filters
+    Raises ValueError for unknown expression.
+    """
+    def __init__(self, volume_selectors):
+        self.volume_ids = []
+        self.volume_filters = []
+        self.size_range = None
+        self.root = None
+
+        for volume_selector in volume_selectors:
+            if volume_selector == "all":
+                continue
+            if volume_selector.startswith("vol-"):
+                self.volume_ids.append(volume_selector)
+                continue
+            if "=" not in volume_selector:
+                raise ValueError("unknown volume selector: {0}".format(volume_selector))
+
+            filter_name, filter_value = [part.strip() for part in volume_selector.split("=", 1)]
+            filter_values = [value.strip() for value in filter_value.split(",")]
+            if filter_name == "root":
+                if filter_value not in ("true", "false"):
+                    raise ValueError("root volume selector should be true or false: {0}".format(volume_selector))
+                self.root = filter_value == "true"
+            elif filter_name == "size" and "-" in filter_value:
+                # DescribeVolumes size filter matches exact size only
+                self.size_range = parse_size_range(filter_value)
+            else:
+                self.volume_filters.append({"Name": FILTER_NAMES.get(filter_name, filter_name), "Values": filter_values})
+
+        self.select_all = not (self.volume_ids or self.volume_filters or self.size_range or self.root is not None)
+
+    def is_filtered(self):
+        # Without expressions volumes are known from instance block devices and DescribeVolumes is not needed
+        return bool(self.volume_filters) or self.size_range is not None or self.root is not None
+
+    def filters(self, instance_ids):
+        volume_filters = [{"Name": "attachment.instance-id", "Values": list(instance_ids)}] + self.volume_filters
+        if self.volume_ids:
+            volume_filters.append({"Name": "volume-id", "Values": self.volume_ids})
+        return volume_filters
+
+    def match(self, volume, attachment, root_device_name=None):
+        if self.size_range is not None:
+            size_min, size_max = self.size_range
+            if (size_min is not None and volume["Size"] < size_min) or (size_max is not None and volume["Size"] > size_max):
+                return False
+        if self.root is not None and (attachment["Device"] == root_device_name) != self.root:
+            return False
+        return True